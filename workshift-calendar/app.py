@@ -1,9 +1,13 @@
 from flask import Flask, request, redirect
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import QueuePool
 import os
 from werkzeug.middleware.proxy_fix import ProxyFix
 import logging
+import time
+import metrics
 
 log_level = os.environ.get("LOG_LEVEL", "info").upper()
 logging.basicConfig(level=getattr(logging, log_level, logging.INFO))
@@ -14,6 +18,12 @@ class Base(DeclarativeBase):
 db = SQLAlchemy(model_class=Base)
 
 INGRESS_MODE = os.environ.get("INGRESS_MODE", "false").lower() == "true"
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() == "true"
+SQLITE_PERFORMANCE = os.environ.get("SQLITE_PERFORMANCE", "true").lower() == "true"
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", "8192"))
+SQLITE_MMAP_SIZE_MB = int(os.environ.get("SQLITE_MMAP_SIZE_MB", "64"))
+WEB_THREADS = int(os.environ.get("WEB_THREADS", "1"))
 
 class IngressMiddleware:
     def __init__(self, app):
@@ -35,17 +45,107 @@ class IngressMiddleware:
                 logging.debug(f"Ingress path set to: {ingress_path}")
         return self.app(environ, start_response)
 
+class MetricsMiddleware:
+    """Record latency, response size and SQL usage per route for the /metrics endpoint.
+
+    Timing stops when the server closes the response, so streamed ICS feeds
+    are measured until their last byte is sent.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        status = ['500']
+
+        def metered_start_response(status_line, headers, exc_info=None):
+            status[0] = status_line.split(' ', 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        def finish(size):
+            metrics.end_request(environ.get('workshift.route', 'unmatched'), environ.get('REQUEST_METHOD', ''),
+                                status[0], time.perf_counter() - started, size)
+
+        metrics.begin_request()
+        try:
+            body = self.app(environ, metered_start_response)
+        except Exception:
+            finish(0)
+            raise
+
+        def metered_body():
+            size = 0
+            try:
+                for chunk in body:
+                    size += len(chunk)
+                    yield chunk
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+                finish(size)
+        return metered_body()
+
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET")
-app.wsgi_app = ProxyFix(IngressMiddleware(app.wsgi_app), x_for=1, x_proto=1, x_host=1, x_prefix=0)
+app.wsgi_app = IngressMiddleware(MetricsMiddleware(app.wsgi_app) if METRICS_ENABLED else app.wsgi_app)
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=0)
 app.url_map.strict_slashes = False
 
+def engine_options(database_url):
+    """Pick pool settings for the configured database.
+
+    Each gunicorn thread can hold a connection, so the pool grows with the
+    configured thread count.
+    """
+    pool_size = max(5, WEB_THREADS)
+    if database_url and database_url.startswith('sqlite'):
+        if ':memory:' in database_url or database_url.rstrip('/') == 'sqlite:':
+            # Flask-SQLAlchemy keeps a single shared connection for in-memory databases
+            return {}
+        # A file database needs no liveness checks or recycling; pooled connections
+        # keep their page cache and pragmas between requests
+        return {
+            'poolclass': QueuePool,
+            'pool_size': pool_size,
+            'max_overflow': 5,
+            'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000, 'check_same_thread': False},
+        }
+    return {
+        'pool_pre_ping': True,
+        "pool_recycle": 300,
+        'pool_size': pool_size,
+    }
+
+def configure_sqlite(engine):
+    """Apply connection pragmas to every new SQLite connection.
+
+    In performance mode the database runs in WAL journal mode so readers
+    (ICS feeds, API reads) no longer wait for a writer in another worker,
+    with synchronous=NORMAL, which stays consistent after a crash but may
+    lose the last commits on power loss.
+
+    Foreign keys are always enforced: deleting a user, calendar or template
+    relies on their ON DELETE rules, which SQLite ignores by default.
+    """
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA foreign_keys = ON")
+        if SQLITE_PERFORMANCE:
+            cursor.execute("PRAGMA journal_mode = WAL")
+            cursor.execute("PRAGMA synchronous = NORMAL")
+            cursor.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+            cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE_MB * 1024 * 1024}")
+            cursor.execute("PRAGMA temp_store = MEMORY")
+        else:
+            cursor.execute("PRAGMA journal_mode = DELETE")
+            cursor.execute("PRAGMA synchronous = FULL")
+        cursor.close()
+
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    'pool_pre_ping': True,
-    "pool_recycle": 300,
-}
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
 
 @app.context_processor
 def inject_ingress_path():
@@ -54,32 +154,19 @@ def inject_ingress_path():
         return {'ingress_path': ingress_path, 'ingress_mode': True}
     return {'ingress_path': '', 'ingress_mode': False}
 
-db.init_app(app)
+@app.before_request
+def tag_metrics_route():
+    # Label metrics with the matched endpoint rather than the raw path
+    if METRICS_ENABLED:
+        request.environ['workshift.route'] = request.endpoint or 'unmatched'
 
-def run_migrations():
-    """Run database migrations for schema changes."""
-    from sqlalchemy import inspect, text
-    
-    inspector = inspect(db.engine)
-    
-    # Check if day_notes table exists
-    if 'day_notes' in inspector.get_table_names():
-        columns = [col['name'] for col in inspector.get_columns('day_notes')]
-        
-        # Add position column if missing (added in v1.0.9)
-        if 'position' not in columns:
-            logging.info("Migrating day_notes table: adding position column...")
-            with db.engine.begin() as conn:
-                # Use dialect-appropriate SQL
-                if 'sqlite' in str(db.engine.url):
-                    conn.execute(text("ALTER TABLE day_notes ADD COLUMN position VARCHAR(20) DEFAULT 'top'"))
-                else:
-                    conn.execute(text("ALTER TABLE day_notes ADD COLUMN position VARCHAR(20) DEFAULT 'top'"))
-                conn.execute(text("UPDATE day_notes SET position = 'top' WHERE position IS NULL"))
-            logging.info("Migration complete: position column added to day_notes")
+db.init_app(app)
 
 with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        configure_sqlite(db.engine)
+    if METRICS_ENABLED:
+        metrics.instrument_engine(db.engine)
     import models
-    run_migrations()
-    db.create_all()
-    logging.info("Database tables created")
+    from migrations import check_schema
+    check_schema()
@@ -0,0 +1,356 @@
+"""Whole-user backups as NDJSON: one JSON record per line.
+
+The export streams templates, calendars, recurrences, shifts and day notes
+straight from the cursor, and the import reads its input line by line and
+writes rows with multi-row INSERTs, committing every BACKUP_BATCH_SIZE
+rows. Memory stays bounded by the batch size and the number of calendars
+and templates, however many shifts there are.
+
+Both are safe to run while the add-on serves requests. The export writes
+each table only for the ids already written, so a calendar or template
+created or deleted mid-export never leaves a dangling reference. The
+import always creates new calendars and templates, so it never touches
+rows other requests are editing. Its short batch transactions keep the
+SQLite write lock brief. Imported calendars get their API keys and their
+first feed version only once every row is in, so integrations never see
+a half-restored calendar under a validator that stays valid afterwards.
+If an import fails, the calendars and templates it created are deleted
+again, and the database cascades to everything else.
+"""
+from datetime import date, datetime, time
+import json
+import os
+import uuid
+
+import click
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from migrations import SCHEMA_VERSION
+from models import (Calendar, DayNote, Shift, ShiftRecurrence, ShiftRecurrenceException, ShiftTemplate,
+                    User)
+from recurrence import normalize_rrule
+from shift_service import MAX_SHIFTS_PER_DAY, skip_full_days
+
+BACKUP_FORMAT = 'workshift-backup'
+BACKUP_FORMAT_VERSION = 1
+BACKUP_BATCH_SIZE = int(os.environ.get("BACKUP_BATCH_SIZE", "1000"))
+
+
+class BackupError(ValueError):
+    """The import input is not a valid backup; carries the offending line number."""
+
+    def __init__(self, line_number, message):
+        super().__init__(f'line {line_number}: {message}')
+        self.line_number = line_number
+
+
+def encode_record(record):
+    return json.dumps(record, separators=(',', ':'), default=lambda value: value.isoformat()) + '\n'
+
+
+def export_records(user_id):
+    """Yield the NDJSON lines of a backup of one user's calendars and templates."""
+    yield encode_record({'type': BACKUP_FORMAT, 'version': BACKUP_FORMAT_VERSION,
+                         'schema_version': SCHEMA_VERSION, 'exported_at': datetime.now()})
+
+    templates = ShiftTemplate.__table__
+    template_ids = set()
+    for row in db.session.execute(db.select(
+            templates.c.id, templates.c.name, templates.c.start_time, templates.c.end_time,
+            templates.c.color, templates.c.description).where(templates.c.user_id == user_id)):
+        template_ids.add(row.id)
+        yield encode_record({'type': 'template', **row._asdict()})
+
+    calendars = Calendar.__table__
+    calendar_ids = []
+    for row in db.session.execute(db.select(
+            calendars.c.id, calendars.c.name, calendars.c.description, calendars.c.color,
+            calendars.c.api_key, calendars.c.is_default).where(calendars.c.user_id == user_id)):
+        calendar_ids.append(row.id)
+        yield encode_record({'type': 'calendar', **row._asdict()})
+    if not calendar_ids:
+        return
+
+    recurrences = ShiftRecurrence.__table__
+    exceptions = ShiftRecurrenceException.__table__
+    recurrence_rows = db.session.execute(db.select(
+        recurrences.c.id, recurrences.c.calendar_id, recurrences.c.template_id, recurrences.c.rrule, recurrences.c.dtstart
+    ).where(recurrences.c.calendar_id.in_(calendar_ids), recurrences.c.template_id.in_(list(template_ids)))).all()
+    exception_dates = {}
+    if recurrence_rows:
+        for recurrence_id, exception_date in db.session.execute(
+                db.select(exceptions.c.recurrence_id, exceptions.c.exception_date)
+                .where(exceptions.c.recurrence_id.in_([r.id for r in recurrence_rows]))
+                .order_by(exceptions.c.exception_date)):
+            exception_dates.setdefault(recurrence_id, []).append(exception_date)
+    for row in recurrence_rows:
+        yield encode_record({'type': 'recurrence', **row._asdict(), 'exceptions': exception_dates.get(row.id, [])})
+
+    shifts = Shift.__table__
+    for row in db.session.execute(db.select(
+            shifts.c.calendar_id, shifts.c.template_id, shifts.c.title, shifts.c.shift_date,
+            shifts.c.start_time, shifts.c.end_time, shifts.c.color, shifts.c.position
+    ).where(shifts.c.calendar_id.in_(calendar_ids)).order_by(shifts.c.calendar_id, shifts.c.shift_date, shifts.c.position)
+            .execution_options(yield_per=BACKUP_BATCH_SIZE)):
+        record = row._asdict()
+        if record['template_id'] not in template_ids:
+            record['template_id'] = None
+        yield encode_record({'type': 'shift', **record})
+
+    notes = DayNote.__table__
+    for row in db.session.execute(db.select(
+            notes.c.calendar_id, notes.c.note_date, notes.c.content, notes.c.position
+    ).where(notes.c.calendar_id.in_(calendar_ids)).order_by(notes.c.calendar_id, notes.c.note_date)
+            .execution_options(yield_per=BACKUP_BATCH_SIZE)):
+        yield encode_record({'type': 'note', **row._asdict()})
+
+
+def new_id():
+    return str(uuid.uuid4())
+
+
+def new_api_key():
+    return str(uuid.uuid4()).replace('-', '')
+
+
+class Importer:
+    """Turns backup records into rows for a target user, buffering them into batched INSERTs.
+
+    Every calendar, template and recurrence gets a new id; the maps from
+    the ids in the backup are the only per-import state besides the
+    pending batches. Records get the same checks as the API: rules are
+    normalized, and shifts are renumbered from 0 within each day and held
+    to the daily limit. A backup lists each day's shifts together, so only
+    the current day is tracked; a day that shows up again collides with
+    its first position in the unique index.
+    """
+
+    def __init__(self, user_id, batch_size=BACKUP_BATCH_SIZE):
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.calendars = {}
+        self.api_keys = {}
+        self.templates = {}
+        self.recurrences = {}
+        self.counts = {'templates': 0, 'calendars': 0, 'recurrences': 0, 'shifts': 0, 'notes': 0}
+        self._pending = {}
+        self._pending_rows = 0
+        self._day = None
+        self._day_shifts = 0
+        self._has_default = db.session.query(Calendar.id).filter_by(user_id=user_id, is_default=True).first() is not None
+
+    def add(self, table, row):
+        self._pending.setdefault(table, []).append(row)
+        self._pending_rows += 1
+        if self._pending_rows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Insert and commit the pending rows, parents first."""
+        if not self._pending_rows:
+            return
+        for table in db.metadata.sorted_tables:
+            rows = self._pending.pop(table, None)
+            if rows:
+                # An executemany of one cached statement; SQLAlchemy sends it as multi-row INSERTs
+                db.session.execute(table.insert(), rows)
+        db.session.commit()
+        self._pending_rows = 0
+
+    def calendar_id(self, record):
+        calendar_id = self.calendars.get(record.get('calendar_id'))
+        if calendar_id is None:
+            raise ValueError(f"unknown calendar {record.get('calendar_id')!r}")
+        return calendar_id
+
+    def template(self, record):
+        template_id = record['id']
+        self.templates[template_id] = new_id()
+        self.add(ShiftTemplate.__table__, {
+            'id': self.templates[template_id], 'user_id': self.user_id, 'name': record['name'],
+            'start_time': time.fromisoformat(record['start_time']), 'end_time': time.fromisoformat(record['end_time']),
+            'color': record.get('color'), 'description': record.get('description'),
+            'created_at': datetime.now(), 'updated_at': datetime.now()
+        })
+        self.counts['templates'] += 1
+
+    def calendar(self, record):
+        calendar_id = record['id']
+        self.calendars[calendar_id] = new_id()
+        api_key = record.get('api_key')
+        # Restoring on a new instance keeps integration URLs working; a second copy gets its own key
+        if not api_key or db.session.query(Calendar.id).filter_by(api_key=api_key).first() is not None:
+            api_key = new_api_key()
+        self.api_keys[self.calendars[calendar_id]] = api_key
+        is_default = bool(record.get('is_default')) and not self._has_default
+        self._has_default = self._has_default or is_default
+        # The calendar can't be reached by its key until publish() sets it
+        self.add(Calendar.__table__, {
+            'id': self.calendars[calendar_id], 'user_id': self.user_id, 'name': record['name'],
+            'description': record.get('description'), 'color': record.get('color'), 'api_key': new_api_key(),
+            'is_default': is_default, 'feed_version': 0, 'sync_floor': 0, 'feed_updated_at': datetime.now(),
+            'created_at': datetime.now(), 'updated_at': datetime.now()
+        })
+        self.counts['calendars'] += 1
+
+    def recurrence(self, record):
+        template_id = self.templates.get(record.get('template_id'))
+        if template_id is None:
+            raise ValueError(f"unknown template {record.get('template_id')!r}")
+        recurrence_id = self.recurrences[record['id']] = new_id()
+        self.add(ShiftRecurrence.__table__, {
+            'id': recurrence_id, 'calendar_id': self.calendar_id(record), 'template_id': template_id,
+            'rrule': normalize_rrule(record['rrule']), 'dtstart': date.fromisoformat(record['dtstart']), 'sync_version': 1,
+            'created_at': datetime.now(), 'updated_at': datetime.now()
+        })
+        for exception_date in record.get('exceptions', []):
+            self.add(ShiftRecurrenceException.__table__, {
+                'id': new_id(), 'recurrence_id': recurrence_id,
+                'exception_date': date.fromisoformat(exception_date), 'created_at': datetime.now()
+            })
+        self.counts['recurrences'] += 1
+
+    def shift(self, record):
+        template_id = record.get('template_id')
+        calendar_id = self.calendar_id(record)
+        shift_date = date.fromisoformat(record['shift_date'])
+        if self._day != (calendar_id, shift_date):
+            self._day = (calendar_id, shift_date)
+            self._day_shifts = 0
+        if self._day_shifts >= MAX_SHIFTS_PER_DAY:
+            raise ValueError(f'more than {MAX_SHIFTS_PER_DAY} shifts on {shift_date.isoformat()}')
+        self.add(Shift.__table__, {
+            'id': new_id(), 'calendar_id': calendar_id,
+            'template_id': self.templates.get(template_id) if template_id else None,
+            'title': record['title'], 'shift_date': shift_date,
+            'start_time': time.fromisoformat(record['start_time']), 'end_time': time.fromisoformat(record['end_time']),
+            'color': record.get('color'), 'position': self._day_shifts, 'sync_version': 1,
+            'created_at': datetime.now(), 'updated_at': datetime.now()
+        })
+        self._day_shifts += 1
+        self.counts['shifts'] += 1
+
+    def note(self, record):
+        self.add(DayNote.__table__, {
+            'id': new_id(), 'calendar_id': self.calendar_id(record),
+            'note_date': date.fromisoformat(record['note_date']), 'content': record['content'],
+            'position': record.get('position') or 'top', 'sync_version': 1,
+            'created_at': datetime.now(), 'updated_at': datetime.now()
+        })
+        self.counts['notes'] += 1
+
+    def publish(self):
+        """Give the imported calendars their API keys and a new feed version in one statement per batch.
+
+        Rows are inserted with sync_version 1 while their calendars stay at
+        feed version 0, so bumping the version here makes any ETag or sync
+        token handed out during the import stale, and live update streams
+        see the change.
+        """
+        calendars = Calendar.__table__
+        publish = calendars.update().where(calendars.c.id == db.bindparam('calendar_id')).values(
+            api_key=db.bindparam('restored_key'), feed_version=calendars.c.feed_version + 1,
+            feed_updated_at=db.bindparam('published_at'))
+        rows = [{'calendar_id': calendar_id, 'restored_key': api_key, 'published_at': datetime.now()}
+                for calendar_id, api_key in self.api_keys.items()]
+        for start in range(0, len(rows), self.batch_size):
+            db.session.execute(publish, rows[start:start + self.batch_size])
+        db.session.commit()
+
+    def skip_full_days(self):
+        """Add exceptions where imported recurrences would push a day past the limit, as creating them does."""
+        if not self.recurrences:
+            return
+        recurrences = {}
+        imported = list(self.recurrences.values())
+        for start in range(0, len(imported), self.batch_size):
+            for recurrence in ShiftRecurrence.query.filter(ShiftRecurrence.id.in_(imported[start:start + self.batch_size])):
+                recurrences.setdefault(recurrence.calendar_id, []).append(recurrence)
+        for calendar_id, calendar_recurrences in recurrences.items():
+            skip_full_days(calendar_id, calendar_recurrences)
+        db.session.flush()
+
+    def discard(self):
+        """Delete everything this import created; the database cascades from calendars and templates."""
+        db.session.rollback()
+        for table, ids in ((Calendar.__table__, self.calendars.values()), (ShiftTemplate.__table__, self.templates.values())):
+            ids = list(ids)
+            for start in range(0, len(ids), self.batch_size):
+                db.session.execute(table.delete().where(table.c.id.in_(ids[start:start + self.batch_size])))
+        db.session.commit()
+
+
+def import_records(user_id, lines):
+    """Import a backup from an iterable of NDJSON lines into a user's account.
+
+    Returns the number of rows created per kind. Raises BackupError for
+    malformed input, after removing what was imported so far.
+    """
+    importer = Importer(user_id)
+    handlers = {'template': importer.template, 'calendar': importer.calendar, 'recurrence': importer.recurrence,
+                'shift': importer.shift, 'note': importer.note}
+    line_number = 0
+    try:
+        for line_number, line in enumerate(lines, 1):
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if line_number == 1:
+                    if record.get('type') != BACKUP_FORMAT:
+                        raise ValueError('not a WorkShift backup')
+                    if record.get('version', 0) > BACKUP_FORMAT_VERSION:
+                        raise ValueError(f"backup format {record['version']} is newer than this release supports")
+                    continue
+                handler = handlers.get(record.get('type'))
+                if handler is None:
+                    raise ValueError(f"unknown record type {record.get('type')!r}")
+                handler(record)
+            except KeyError as e:
+                raise BackupError(line_number, f'missing field {e}') from e
+            except (ValueError, TypeError, AttributeError) as e:
+                raise BackupError(line_number, str(e)) from e
+        if line_number == 0:
+            raise BackupError(1, 'empty backup')
+        importer.flush()
+        importer.skip_full_days()
+        importer.publish()
+    except IntegrityError as e:
+        importer.discard()
+        # Rows are inserted in batches, so the conflict is somewhere in the last batch read
+        raise BackupError(line_number, "a day's shifts are not listed together, or two notes are on the same day") from e
+    except Exception:
+        importer.discard()
+        raise
+    return importer.counts
+
+
+def find_user(username):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f'No user named {username!r}')
+    return user
+
+
+@app.cli.command('export-user')
+@click.argument('username')
+@click.argument('output', type=click.File('w'), default='-')
+def export_user_command(username, output):
+    """Write a backup of USERNAME's calendars to OUTPUT (default: stdout)."""
+    for line in export_records(find_user(username).id):
+        output.write(line)
+
+
+@app.cli.command('import-user')
+@click.argument('username')
+@click.argument('backup', type=click.File('rb'), default='-')
+def import_user_command(username, backup):
+    """Import a backup from BACKUP (default: stdin) into USERNAME's account as new calendars."""
+    try:
+        counts = import_records(find_user(username).id, backup)
+    except BackupError as e:
+        raise click.ClickException(str(e))
+    click.echo(', '.join(f'{count} {kind}' for kind, count in counts.items()))
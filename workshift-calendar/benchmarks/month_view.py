@@ -0,0 +1,73 @@
+"""Measure month-view shift query latency with and without the shift indexes.
+
+Usage (from the workshift-calendar directory):
+
+    python benchmarks/month_view.py --shifts 100000 --calendars 20
+"""
+import argparse
+import atexit
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--shifts', type=int, default=100000)
+parser.add_argument('--calendars', type=int, default=20)
+parser.add_argument('--iterations', type=int, default=200)
+args = parser.parse_args()
+
+db_dir = tempfile.mkdtemp(prefix='workshift-bench-')
+atexit.register(shutil.rmtree, db_dir, ignore_errors=True)
+os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(db_dir, "bench.db")}'
+os.environ.setdefault('SESSION_SECRET', 'benchmark')
+os.environ.setdefault('LOG_LEVEL', 'warning')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db  # noqa: E402
+from models import Calendar, Shift  # noqa: E402
+from seed import seed  # noqa: E402
+
+
+def month_view_latencies(user_id, calendars, first_date):
+    timings = []
+    for i in range(args.iterations):
+        calendar = calendars[i % len(calendars)]
+        start = first_date + timedelta(days=30 * (i % 48))
+        end = start + timedelta(days=90)
+        began = time.perf_counter()
+        Shift.query.join(Calendar).filter(
+            Calendar.user_id == user_id,
+            Shift.calendar_id == calendar['id'],
+            Shift.shift_date >= start,
+            Shift.shift_date <= end,
+        ).order_by(Shift.shift_date, Shift.position).all()
+        timings.append((time.perf_counter() - began) * 1000)
+        db.session.expunge_all()
+    return timings
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f'{label:<16} mean {statistics.mean(timings):8.2f} ms   p50 {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms')
+
+
+with app.app_context():
+    seeded = seed(users=1, calendars_per_user=args.calendars, shifts=args.shifts)
+    user_id = seeded['users'][0]
+    print(f"Seeded {seeded['shifts']} shifts across {len(seeded['calendars'])} calendars")
+    
+    shift_indexes = list(Shift.__table__.indexes)
+    for index in shift_indexes:
+        index.drop(db.engine)
+    report('without indexes', month_view_latencies(user_id, seeded['calendars'], seeded['first_date']))
+    
+    for index in shift_indexes:
+        index.create(db.engine)
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql('ANALYZE')
+    report('with indexes', month_view_latencies(user_id, seeded['calendars'], seeded['first_date']))
@@ -0,0 +1,348 @@
+"""Load-test the REST, ICS and webhook endpoints against a seeded SQLite database.
+
+Usage (from the workshift-calendar directory):
+
+    python benchmarks/run.py --shifts 50000 --output report.json
+    python benchmarks/run.py --gunicorn --workers 2 --concurrency 8 --output report.json
+    python benchmarks/run.py --compare baseline.json --output report.json
+    python benchmarks/run.py --gunicorn --background ics_feed --endpoints api_calendar_view
+
+Requests go through the Flask test client by default, or over HTTP to a local
+gunicorn started on the same database with --gunicorn. The JSON report holds
+latency percentiles and throughput per endpoint; --compare prints the change
+against an earlier report and exits non-zero on regressions. --background
+keeps requesting one endpoint (e.g. full ICS feeds) while the others are
+measured, to see how slow clients affect the rest of the app.
+"""
+import argparse
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+import http.cookiejar
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--users', type=int, default=2)
+parser.add_argument('--calendars', type=int, default=2, help='calendars per user')
+parser.add_argument('--templates', type=int, default=4, help='templates per user')
+parser.add_argument('--shifts', type=int, default=20000)
+parser.add_argument('--notes', type=int, default=2000)
+parser.add_argument('--iterations', type=int, default=200, help='requests per endpoint')
+parser.add_argument('--ics-iterations', type=int, default=20, help='requests for the full ICS feed')
+parser.add_argument('--warmup', type=int, default=5)
+parser.add_argument('--concurrency', type=int, default=1)
+parser.add_argument('--endpoints', help='comma-separated subset of endpoints to run')
+parser.add_argument('--gunicorn', action='store_true', help='benchmark a local gunicorn instead of the test client')
+parser.add_argument('--workers', type=int, default=2)
+parser.add_argument('--worker-class', default='sync')
+parser.add_argument('--threads', type=int, default=1)
+parser.add_argument('--background', help='endpoint to request continuously while the others are measured')
+parser.add_argument('--background-concurrency', type=int, default=2)
+parser.add_argument('--output', help='write the JSON report to this path')
+parser.add_argument('--compare', help='earlier JSON report to compare against')
+parser.add_argument('--regression-threshold', type=float, default=10.0,
+                    help='percent p95 increase that counts as a regression')
+args = parser.parse_args()
+
+db_dir = tempfile.mkdtemp(prefix='workshift-bench-')
+atexit.register(shutil.rmtree, db_dir, ignore_errors=True)
+os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(db_dir, "bench.db")}'
+os.environ.setdefault('SESSION_SECRET', 'benchmark')
+os.environ.setdefault('LOG_LEVEL', 'warning')
+sys.path.insert(0, APP_DIR)
+
+from app import app  # noqa: E402
+import routes  # noqa: E402,F401
+from seed import PASSWORD, seed  # noqa: E402
+
+
+class TestClientSession:
+    """Issues requests in-process through the Flask test client."""
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, json=body)
+        size = len(response.get_data())
+        return response.status_code, size
+
+
+class HttpSession:
+    """Issues requests over HTTP, keeping the session cookie between calls."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, body=None):
+        data = None
+        headers = {}
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif method == 'POST' and path == '/login':
+            data = urllib.parse.urlencode({'username': self.username, 'password': PASSWORD}).encode()
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with self.opener.open(req) as response:
+                return response.status, len(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, len(e.read())
+
+
+def login(session, username):
+    if isinstance(session, HttpSession):
+        session.username = username
+        status, _ = session.request('POST', '/login')
+    else:
+        status = session.client.post('/login', data={'username': username, 'password': PASSWORD}).status_code
+    if status not in (200, 302):
+        raise RuntimeError(f'Login failed with status {status}')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn():
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}',
+         '--workers', str(args.workers), '--worker-class', args.worker_class,
+         '--threads', str(args.threads), '--log-level', 'warning', 'main:app'],
+        cwd=APP_DIR, env=dict(os.environ)
+    )
+    atexit.register(process.terminate)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return f'http://127.0.0.1:{port}'
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn did not start within 30 seconds')
+
+
+def build_scenarios(dataset):
+    """Map endpoint name to (iterations, request factory taking the iteration number)."""
+    calendars = [c for c in dataset['calendars'] if c['user_id'] == dataset['users'][0]]
+    first = dataset['first_date']
+    span_days = max(1, dataset['shifts'] // max(1, len(dataset['calendars'])))
+
+    def window(i, days):
+        start = first + timedelta(days=(i * 29) % span_days)
+        return start.isoformat(), (start + timedelta(days=days)).isoformat()
+
+    def calendar(i):
+        return calendars[i % len(calendars)]
+
+    webhook_counter = iter(range(10 ** 9))
+    webhook_lock = threading.Lock()
+
+    def webhook(i):
+        # Each create lands on a fresh far-future day so the 2-per-day limit never triggers
+        with webhook_lock:
+            n = next(webhook_counter)
+        shift_date = (date(2100, 1, 1) + timedelta(days=n)).isoformat()
+        return 'POST', f"/webhook/{calendar(i)['api_key']}", {'action': 'create', 'date': shift_date, 'title': 'Bench'}
+
+    def api_shifts(i):
+        start, end = window(i, 90)
+        return 'GET', f"/api/shifts?calendar_id={calendar(i)['id']}&start={start}&end={end}", None
+
+    def api_day_notes(i):
+        start, end = window(i, 90)
+        return 'GET', f"/api/day-notes?calendar_id={calendar(i)['id']}&start={start}&end={end}", None
+
+    def api_calendar_view(i):
+        start, end = window(i, 90)
+        return 'GET', f"/api/calendar-view?calendar_id={calendar(i)['id']}&start={start}&end={end}", None
+
+    def ics_feed(i):
+        return 'GET', f"/ics/{calendar(i)['api_key']}.ics", None
+
+    def ics_feed_window(i):
+        start, end = window(i, 365)
+        return 'GET', f"/ics/{calendar(i)['api_key']}.ics?start={start}&end={end}", None
+
+    def external_api_events(i):
+        start, end = window(i, 90)
+        return 'GET', f"/api/v1/calendar/{calendar(i)['api_key']}/events?start={start}&end={end}", None
+
+    return {
+        'api_shifts': (args.iterations, api_shifts),
+        'api_day_notes': (args.iterations, api_day_notes),
+        'api_calendar_view': (args.iterations, api_calendar_view),
+        'ics_feed': (args.ics_iterations, ics_feed),
+        'ics_feed_window': (args.iterations, ics_feed_window),
+        'external_api_events': (args.iterations, external_api_events),
+        'webhook_receiver': (args.iterations, webhook),
+    }
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(make_session, iterations, factory):
+    local = threading.local()
+
+    def one(i):
+        if not hasattr(local, 'session'):
+            local.session = make_session()
+        method, path, body = factory(i)
+        began = time.perf_counter()
+        status, size = local.session.request(method, path, body)
+        return (time.perf_counter() - began) * 1000, status, size
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, range(args.warmup)))
+        began = time.perf_counter()
+        samples = list(pool.map(one, range(args.warmup, args.warmup + iterations)))
+        elapsed = time.perf_counter() - began
+
+    latencies = sorted(s[0] for s in samples)
+    errors = sum(1 for s in samples if s[1] >= 400)
+    return {
+        'requests': iterations,
+        'errors': errors,
+        'throughput_rps': round(iterations / elapsed, 2) if elapsed else None,
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p90_ms': round(percentile(latencies, 90), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(latencies[-1], 3),
+        'mean_response_bytes': round(sum(s[2] for s in samples) / len(samples)),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=APP_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    """Print p50/p95 changes against a baseline report and return the regressed endpoints."""
+    regressions = []
+    print(f"\n{'endpoint':<22}{'p50 old':>10}{'p50 new':>10}{'p95 old':>10}{'p95 new':>10}{'change':>9}")
+    for name, result in report['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if not old:
+            continue
+        change = (result['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 if old['p95_ms'] else 0.0
+        flag = ''
+        if change > args.regression_threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<22}{old['p50_ms']:>10.2f}{result['p50_ms']:>10.2f}"
+              f"{old['p95_ms']:>10.2f}{result['p95_ms']:>10.2f}{change:>8.1f}%{flag}")
+    return regressions
+
+
+def main():
+    with app.app_context():
+        dataset = seed(users=args.users, calendars_per_user=args.calendars, templates_per_user=args.templates,
+                       shifts=args.shifts, notes=args.notes)
+    print(f"Seeded {dataset['shifts']} shifts, {dataset['notes']} notes, {len(dataset['calendars'])} calendars "
+          f"for {args.users} users")
+
+    if args.gunicorn:
+        base_url = start_gunicorn()
+
+        def make_session():
+            session = HttpSession(base_url)
+            login(session, dataset['usernames'][0])
+            return session
+    else:
+        def make_session():
+            session = TestClientSession()
+            login(session, dataset['usernames'][0])
+            return session
+
+    scenarios = build_scenarios(dataset)
+    if args.endpoints:
+        wanted = args.endpoints.split(',')
+        scenarios = {name: scenarios[name] for name in wanted}
+
+    stop_background = threading.Event()
+    background_threads = []
+    if args.background:
+        background_factory = build_scenarios(dataset)[args.background][1]
+
+        def background_load(offset):
+            session = make_session()
+            i = offset
+            while not stop_background.is_set():
+                session.request(*background_factory(i))
+                i += args.background_concurrency
+
+        for offset in range(args.background_concurrency):
+            thread = threading.Thread(target=background_load, args=(offset,), daemon=True)
+            thread.start()
+            background_threads.append(thread)
+
+    results = {}
+    for name, (iterations, factory) in scenarios.items():
+        results[name] = run_scenario(make_session, iterations, factory)
+        r = results[name]
+        print(f"{name:<22} p50 {r['p50_ms']:8.2f} ms  p95 {r['p95_ms']:8.2f} ms  p99 {r['p99_ms']:8.2f} ms  "
+              f"{r['throughput_rps']:8.1f} req/s  errors {r['errors']}")
+    stop_background.set()
+    for thread in background_threads:
+        thread.join()
+
+    report = {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'mode': 'gunicorn' if args.gunicorn else 'test_client',
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'dataset': {
+            'users': args.users,
+            'calendars': len(dataset['calendars']),
+            'templates': dataset['templates'],
+            'shifts': dataset['shifts'],
+            'notes': dataset['notes'],
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Report written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f))
+        if regressions:
+            print(f"Regressions over {args.regression_threshold}%: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Seed a WorkShift database with synthetic users, calendars, templates, shifts and notes.
+
+Rows are written with batched Core inserts so six-figure shift counts seed in seconds.
+The app must already be imported with DATABASE_URL pointing at the target database.
+"""
+from datetime import date, time, timedelta
+import random
+import uuid
+
+from werkzeug.security import generate_password_hash
+
+from app import db
+from models import User, Calendar, ShiftTemplate, Shift, DayNote
+
+BATCH_SIZE = 5000
+PASSWORD = 'benchmark'
+TEMPLATE_HOURS = [(6, 14), (14, 22), (22, 6), (9, 17)]
+
+
+def _insert_batches(table, rows):
+    for i in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(table.insert(), rows[i:i + BATCH_SIZE])
+
+
+def seed(users=1, calendars_per_user=1, templates_per_user=4, shifts=100000, notes=5000,
+         start=date(2015, 1, 1), seed_value=42):
+    """Populate the database and return a dict describing what was created."""
+    rng = random.Random(seed_value)
+    password_hash = generate_password_hash(PASSWORD)
+    user_rows, calendar_rows, template_rows = [], [], []
+    for u in range(users):
+        user_id = str(uuid.uuid4())
+        user_rows.append({'id': user_id, 'username': f'bench{u}', 'password_hash': password_hash})
+        for c in range(calendars_per_user):
+            calendar_rows.append({'id': str(uuid.uuid4()), 'user_id': user_id, 'name': f'Calendar {c}',
+                                  'api_key': uuid.uuid4().hex, 'feed_version': 0})
+        for t in range(templates_per_user):
+            start_hour, end_hour = TEMPLATE_HOURS[t % len(TEMPLATE_HOURS)]
+            template_rows.append({'id': str(uuid.uuid4()), 'user_id': user_id, 'name': f'Template {t}',
+                                  'start_time': time(start_hour), 'end_time': time(end_hour), 'color': '#3788d8'})
+    templates_by_user = {}
+    for row in template_rows:
+        templates_by_user.setdefault(row['user_id'], []).append(row['id'])
+
+    # Spread shifts evenly across calendars; each calendar fills consecutive days with 1-2 shifts
+    shift_rows = []
+    per_calendar = max(1, shifts // max(1, len(calendar_rows)))
+    for calendar in calendar_rows:
+        templates = templates_by_user.get(calendar['user_id'], [])
+        day = start
+        created = 0
+        while created < per_calendar:
+            for position in range(min(rng.choice((1, 1, 2)), per_calendar - created)):
+                shift_rows.append({
+                    'id': str(uuid.uuid4()), 'calendar_id': calendar['id'],
+                    'template_id': rng.choice(templates) if templates and rng.random() < 0.8 else None,
+                    'title': 'Shift', 'shift_date': day, 'start_time': time(9), 'end_time': time(17),
+                    'color': '#3788d8', 'position': position,
+                })
+                created += 1
+            day += timedelta(days=1)
+
+    note_rows = []
+    per_calendar_notes = notes // max(1, len(calendar_rows))
+    for calendar in calendar_rows:
+        for offset in rng.sample(range(per_calendar_notes * 3), per_calendar_notes):
+            note_rows.append({'id': str(uuid.uuid4()), 'calendar_id': calendar['id'],
+                              'note_date': start + timedelta(days=offset), 'content': 'Benchmark note',
+                              'position': 'top'})
+
+    _insert_batches(User.__table__, user_rows)
+    _insert_batches(Calendar.__table__, calendar_rows)
+    _insert_batches(ShiftTemplate.__table__, template_rows)
+    _insert_batches(Shift.__table__, shift_rows)
+    _insert_batches(DayNote.__table__, note_rows)
+    db.session.commit()
+    return {
+        'users': [r['id'] for r in user_rows],
+        'usernames': [r['username'] for r in user_rows],
+        'calendars': calendar_rows,
+        'templates': len(template_rows),
+        'shifts': len(shift_rows),
+        'notes': len(note_rows),
+        'first_date': start,
+    }
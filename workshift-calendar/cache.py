@@ -0,0 +1,130 @@
+from collections import OrderedDict, namedtuple
+import logging
+import os
+import tempfile
+import threading
+import time
+
+CACHE_DIR = os.environ.get("CACHE_DIR") or os.path.join(tempfile.gettempdir(), "workshift-cache")
+API_KEY_CACHE_TTL = float(os.environ.get("API_KEY_CACHE_TTL", "60"))
+API_KEY_CACHE_SIZE = int(os.environ.get("API_KEY_CACHE_SIZE", "1024"))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "30"))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "256"))
+
+CalendarRef = namedtuple('CalendarRef', ['id', 'name', 'user_id'])
+
+
+# set() without a generation stores unconditionally
+_ANY_GENERATION = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ttl seconds.
+
+    Each gunicorn worker has its own instance. A named cache shares its
+    invalidations through a generation file in CACHE_DIR: invalidating
+    replaces the file, every lookup stat()s it, and a worker that sees a
+    new generation drops all of its entries. A rotated key or deleted user
+    therefore stops resolving in every worker at once; only if the file
+    can't be written does invalidation stay local, with the TTL bounding
+    how long other workers serve a stale entry.
+
+    Invalidate after the change is committed, and store values read from
+    the database with the generation() taken before the read: set() drops
+    a value when an invalidation happened in between, so a request that
+    read the old row can't cache it again.
+    """
+
+    def __init__(self, max_entries, ttl, name=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation_path = os.path.join(CACHE_DIR, f'{name}.generation') if name else None
+        self._generation = self._read_generation()
+
+    def _read_generation(self):
+        if self._generation_path is None:
+            return None
+        try:
+            stat = os.stat(self._generation_path)
+        except OSError:
+            return None
+        # os.replace() gives the file a new inode, so a replacement within the same mtime tick still counts
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _bump_generation(self):
+        if self._generation_path is None:
+            return
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            temp_path = f'{self._generation_path}.{os.getpid()}.{threading.get_ident()}'
+            with open(temp_path, 'w') as f:
+                f.write(str(time.time_ns()))
+            os.replace(temp_path, self._generation_path)
+        except OSError as e:
+            logging.warning(f"Could not share cache invalidation with other workers: {e}")
+
+    def generation(self):
+        """The shared generation, dropping every local entry if another worker invalidated since the last look."""
+        generation = self._read_generation()
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+        return generation
+
+    def get(self, key):
+        self.generation()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, generation=_ANY_GENERATION):
+        if generation is not _ANY_GENERATION and self.generation() != generation:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        self._bump_generation()
+
+    def invalidate_where(self, predicate):
+        """Drop every entry whose value matches predicate."""
+        with self._lock:
+            for key in [k for k, (_, value) in self._entries.items() if predicate(value)]:
+                del self._entries[key]
+        self._bump_generation()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+api_key_cache = TTLCache(API_KEY_CACHE_SIZE, API_KEY_CACHE_TTL, name='api_keys')
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL, name='users')
@@ -0,0 +1,67 @@
+"""HTTP caching policy applied to every response.
+
+- Static files linked with their content fingerprint (?v=...) are cached
+  for a year; a changed file gets a new URL. Unfingerprinted requests are
+  revalidated against the file's ETag and Last-Modified.
+- Views marked no_store (login, settings, API keys, admin data) are never
+  written to a browser or proxy cache, and neither are responses to
+  writes.
+- Everything else may be kept by the browser but is revalidated on each
+  use. JSON reads get an ETag of their body, so an unchanged listing is
+  answered with 304 Not Modified.
+
+Views that set their own Cache-Control (ICS feeds, event streams,
+/metrics) keep it.
+"""
+import hashlib
+
+from flask import current_app, request
+from werkzeug.security import safe_join
+
+STATIC_MAX_AGE = 365 * 24 * 3600
+IMMUTABLE = f'public, max-age={STATIC_MAX_AGE}, immutable'
+REVALIDATE = 'no-cache'
+PRIVATE_REVALIDATE = 'private, no-cache'
+NO_STORE = 'no-store'
+
+# Static files don't change while the add-on runs, so each is hashed once per worker
+_fingerprints = {}
+
+
+def static_fingerprint(filename):
+    """Short content hash of a static file, or None if it doesn't exist."""
+    if filename not in _fingerprints:
+        path = safe_join(current_app.static_folder, filename)
+        try:
+            with open(path, 'rb') as f:
+                _fingerprints[filename] = hashlib.sha256(f.read()).hexdigest()[:12]
+        except (OSError, TypeError):
+            return None
+    return _fingerprints[filename]
+
+
+def no_store(view):
+    """Mark a view whose responses must not be cached anywhere."""
+    view.cache_policy = NO_STORE
+    return view
+
+
+def apply_cache_policy(response):
+    if request.endpoint == 'static':
+        fingerprint = request.args.get('v')
+        if fingerprint and response.status_code == 200 and fingerprint == static_fingerprint(request.view_args['filename']):
+            response.headers['Cache-Control'] = IMMUTABLE
+        else:
+            response.headers['Cache-Control'] = REVALIDATE
+        return response
+    if 'Cache-Control' in response.headers:
+        return response
+    view = current_app.view_functions.get(request.endpoint)
+    if getattr(view, 'cache_policy', None) == NO_STORE or request.method not in ('GET', 'HEAD'):
+        response.headers['Cache-Control'] = NO_STORE
+        return response
+    response.headers['Cache-Control'] = PRIVATE_REVALIDATE
+    if response.status_code == 200 and response.is_json and not response.is_streamed:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
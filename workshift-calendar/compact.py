@@ -0,0 +1,109 @@
+"""Column-oriented encodings for shift, day note and external event listings.
+
+Requested with ?format=compact. Instead of one object per row repeating
+the same keys, a response carries one array per field, with entry i of
+every array belonging to row i, and dictionaries for values many rows
+share: calendar ids and the distinct display kinds (template, title,
+times and color) shifts are drawn with. Times are formatted once per
+kind rather than once per row.
+"""
+
+FORMAT_COMPACT = 'compact'
+
+
+class Dictionary:
+    """Assigns each distinct value a stable index in first-seen order."""
+
+    def __init__(self):
+        self.values = []
+        self._index = {}
+
+    def index(self, value):
+        position = self._index.get(value)
+        if position is None:
+            position = self._index[value] = len(self.values)
+            self.values.append(value)
+        return position
+
+
+def wants_compact(args):
+    return args.get('format') == FORMAT_COMPACT
+
+
+def shift_entries(rows, occurrences):
+    """(date, position, id, calendar_id, kind, recurrence_id) tuples for stored shift rows and occurrences, in order."""
+    entries = [(r.shift_date, r.position, r.id, r.calendar_id,
+                (r.template_id, r.title, r.start_time, r.end_time, r.color), None) for r in rows]
+    if occurrences:
+        for o in occurrences:
+            template = o.recurrence.template
+            entries.append((o.date, o.position, o.id, o.recurrence.calendar_id,
+                            (template.id, template.name, template.start_time, template.end_time, template.color),
+                            o.recurrence.id))
+        entries.sort(key=lambda entry: (entry[0], entry[1]))
+    return entries
+
+
+def encode_shifts(rows, occurrences=()):
+    """Compact api_shifts payload from shift_rows() rows and recurrence occurrences."""
+    calendars = Dictionary()
+    kinds = Dictionary()
+    columns = {'id': [], 'date': [], 'position': [], 'calendar': [], 'kind': [], 'recurrence_id': []}
+    for day, position, shift_id, calendar_id, kind, recurrence_id in shift_entries(rows, occurrences):
+        columns['id'].append(shift_id)
+        columns['date'].append(day.isoformat())
+        columns['position'].append(position)
+        columns['calendar'].append(calendars.index(calendar_id))
+        columns['kind'].append(kinds.index(kind))
+        columns['recurrence_id'].append(recurrence_id)
+    return {
+        'format': FORMAT_COMPACT,
+        'calendars': calendars.values,
+        'kinds': [{
+            'template_id': template_id,
+            'title': title,
+            'start_time': start_time.strftime('%H:%M'),
+            'end_time': end_time.strftime('%H:%M'),
+            'color': color
+        } for template_id, title, start_time, end_time, color in kinds.values],
+        'shifts': columns
+    }
+
+
+def encode_notes(rows):
+    """Compact api_day_notes payload from note_rows() rows."""
+    calendars = Dictionary()
+    columns = {'id': [], 'date': [], 'content': [], 'calendar': [], 'position': []}
+    for row in rows:
+        columns['id'].append(row.id)
+        columns['date'].append(row.note_date.isoformat())
+        columns['content'].append(row.content)
+        columns['calendar'].append(calendars.index(row.calendar_id))
+        columns['position'].append(row.position or 'top')
+    return {'format': FORMAT_COMPACT, 'calendars': calendars.values, 'notes': columns}
+
+
+def encode_events(rows, occurrences, day_notes):
+    """Compact external events payload; day notes are sent once per date instead of per event."""
+    kinds = Dictionary()
+    columns = {'id': [], 'date': [], 'position': [], 'kind': [], 'recurrence_id': []}
+    descriptions = {}
+    for day, position, event_id, _, kind, recurrence_id in shift_entries(rows, occurrences):
+        date_text = day.isoformat()
+        columns['id'].append(event_id)
+        columns['date'].append(date_text)
+        columns['position'].append(position)
+        columns['kind'].append(kinds.index(kind[1:4]))
+        columns['recurrence_id'].append(recurrence_id)
+        if day in day_notes:
+            descriptions[date_text] = day_notes[day]
+    return {
+        'format': FORMAT_COMPACT,
+        'kinds': [{
+            'summary': summary,
+            'start_time': start_time.strftime('%H:%M'),
+            'end_time': end_time.strftime('%H:%M')
+        } for summary, start_time, end_time in kinds.values],
+        'descriptions': descriptions,
+        'events': columns
+    }
@@ -0,0 +1,110 @@
+import gzip
+import os
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", "5"))
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/calendar'}
+
+
+def choose_encoding():
+    """Best content coding the client accepts: br when the brotli module is installed, else gzip."""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def stream_compressor(encoding):
+    """Return (compress, finish) functions for compressing a body chunk by chunk."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+    # wbits=31 writes a gzip header and trailer; mtime is left at 0 as with gzip.compress
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress, compressor.flush
+
+
+def compress_chunks(chunks, encoding):
+    compress, finish = stream_compressor(encoding)
+    for chunk in chunks:
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def compress_streamed(response, encoding):
+    """Compress a streamed body as it is sent.
+
+    The first chunks are read ahead up to COMPRESS_MIN_SIZE; a body that
+    ends before that is sent as is.
+    """
+    source = response.response
+    chunks = response.iter_encoded()
+    head = []
+    size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= COMPRESS_MIN_SIZE:
+            break
+    else:
+        response.set_data(b''.join(head))
+        return response
+
+    def body():
+        yield from head
+        yield from chunks
+
+    response.response = compress_chunks(body(), encoding)
+    if hasattr(source, 'close'):
+        response.call_on_close(source.close)
+    response.headers.pop('Content-Length', None)
+    return response
+
+
+def compress_response(response):
+    """Compress a JSON, NDJSON or ICS response body if it is large enough and the client accepts it.
+
+    A strong ETag becomes weak, since it describes the uncompressed body.
+    """
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response = compress_streamed(response, encoding)
+        if response.is_streamed:
+            mark_encoded(response, encoding)
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0))
+    mark_encoded(response, encoding)
+    return response
+
+
+def mark_encoded(response, encoding):
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
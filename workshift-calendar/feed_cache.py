@@ -0,0 +1,40 @@
+from collections import OrderedDict
+import os
+import threading
+
+ICS_EVENT_CACHE_SIZE = int(os.environ.get("ICS_EVENT_CACHE_SIZE", "20000"))
+
+
+class EventCache:
+    """LRU cache of serialized VEVENT components keyed by shift id.
+
+    Each entry stores the values the event was rendered from, so a changed
+    shift, template or day note simply misses and gets re-rendered.
+    """
+
+    def __init__(self, max_entries=ICS_EVENT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, signature):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != signature:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, signature, data):
+        with self._lock:
+            self._entries[key] = (signature, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+event_cache = EventCache()
@@ -1,16 +1,38 @@
 from functools import wraps
 from flask import redirect, url_for, session, request
 from flask_login import LoginManager, current_user
-from app import app
+from app import app, db
 from models import User
+from cache import user_cache
 
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
 
+def get_cached_user(user_id):
+    """Load a user through the process-level cache without querying the users table on a hit.
+    
+    The cache holds detached snapshots that are only ever read; each request
+    gets its own session-bound copy via merge(load=False), so no SQL is
+    emitted and no two threads share an instance. Deleting a user
+    invalidates the cache in every worker, so the account is logged out
+    everywhere on its next request.
+    """
+    cached = user_cache.get(user_id)
+    if cached is None:
+        generation = user_cache.generation()
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        db.session.expunge(user)
+        user_cache.set(user_id, user, generation)
+        cached = user
+    return db.session.merge(cached, load=False)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    return get_cached_user(user_id)
 
 
 def require_login(f):
@@ -0,0 +1,165 @@
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import event
+
+METRICS_DIR = os.environ.get("METRICS_DIR") or os.path.join(tempfile.gettempdir(), "workshift-metrics")
+SNAPSHOT_INTERVAL = 5.0
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+HISTOGRAMS = {
+    'workshift_http_request_duration_seconds': ('Request latency by route', LATENCY_BUCKETS),
+    'workshift_http_response_size_bytes': ('Response body size by route', SIZE_BUCKETS),
+    'workshift_db_queries_per_request': ('SQL statements executed per request by route', QUERY_COUNT_BUCKETS),
+    'workshift_db_query_duration_seconds': ('Time spent in SQL per request by route', LATENCY_BUCKETS),
+}
+
+_local = threading.local()
+
+
+class Registry:
+    """Per-process request metrics, periodically written to METRICS_DIR so any worker can report all of them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.histograms = {name: {} for name in HISTOGRAMS}
+        self.collectors = {}
+        self._last_snapshot = 0.0
+
+    def register_counter(self, name, help_text, label, collect):
+        """Export a counter read from collect(), which returns {label value: count} for this process."""
+        self.collectors[name] = (help_text, label, collect)
+
+    def _observe(self, name, route, value):
+        buckets = HISTOGRAMS[name][1]
+        series = self.histograms[name].setdefault(route, {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series['buckets'][i] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    def record(self, route, method, status, duration, size, queries, query_time):
+        with self._lock:
+            key = f'{route}|{method}|{status}'
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self._observe('workshift_http_request_duration_seconds', route, duration)
+            self._observe('workshift_http_response_size_bytes', route, size)
+            self._observe('workshift_db_queries_per_request', route, queries)
+            self._observe('workshift_db_query_duration_seconds', route, query_time)
+            if time.monotonic() - self._last_snapshot >= SNAPSHOT_INTERVAL:
+                self._last_snapshot = time.monotonic()
+                self._write_snapshot()
+
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        return json.loads(json.dumps({
+            'requests': self.requests,
+            'histograms': self.histograms,
+            'counters': {name: collect() for name, (_, _, collect) in self.collectors.items()},
+        }))
+
+    def _write_snapshot(self):
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self._state(), f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logging.debug(f"Could not write metrics snapshot: {e}")
+
+
+registry = Registry()
+
+
+def begin_request():
+    _local.queries = 0
+    _local.query_time = 0.0
+
+
+def end_request(route, method, status, duration, size):
+    registry.record(route, method, status, duration, size,
+                    getattr(_local, 'queries', 0), getattr(_local, 'query_time', 0.0))
+
+
+def instrument_engine(engine):
+    """Count SQL statements and their time against the request running on this thread."""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started'].pop()
+        if hasattr(_local, 'queries'):
+            _local.queries += 1
+            _local.query_time += time.perf_counter() - started
+
+
+def _merged_state():
+    merged = registry.state()
+    own = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        if path == own:
+            continue
+        try:
+            with open(path) as f:
+                other = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for key, count in other.get('requests', {}).items():
+            merged['requests'][key] = merged['requests'].get(key, 0) + count
+        for name, routes in other.get('histograms', {}).items():
+            for route, series in routes.items():
+                target = merged['histograms'].setdefault(name, {}).setdefault(
+                    route, {'buckets': [0] * len(series['buckets']), 'sum': 0.0, 'count': 0})
+                target['buckets'] = [a + b for a, b in zip(target['buckets'], series['buckets'])]
+                target['sum'] += series['sum']
+                target['count'] += series['count']
+        for name, samples in other.get('counters', {}).items():
+            target = merged['counters'].setdefault(name, {})
+            for label, value in samples.items():
+                target[label] = target.get(label, 0) + value
+    return merged
+
+
+def render():
+    """Render all workers' metrics in the Prometheus text exposition format."""
+    state = _merged_state()
+    lines = [
+        '# HELP workshift_http_requests_total Requests by route, method and status',
+        '# TYPE workshift_http_requests_total counter',
+    ]
+    for key, count in sorted(state['requests'].items()):
+        route, method, status = key.split('|')
+        lines.append(f'workshift_http_requests_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for route, series in sorted(state['histograms'].get(name, {}).items()):
+            for bound, count in zip(buckets, series['buckets']):
+                lines.append(f'{name}_bucket{{route="{route}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{route="{route}",le="+Inf"}} {series["count"]}')
+            lines.append(f'{name}_sum{{route="{route}"}} {series["sum"]}')
+            lines.append(f'{name}_count{{route="{route}"}} {series["count"]}')
+
+    for name, (help_text, label_name, _) in registry.collectors.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for label, value in sorted(state['counters'].get(name, {}).items()):
+            lines.append(f'{name}{{{label_name}="{label}"}} {value}')
+    return '\n'.join(lines) + '\n'
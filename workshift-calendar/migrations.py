@@ -0,0 +1,295 @@
+"""Versioned schema migrations.
+
+The applied version is recorded in the schema_version table. run.sh calls
+migrate() once before gunicorn starts; each worker then only runs
+check_schema(), a single SELECT, instead of reflecting every table.
+
+To change the schema, append a step to MIGRATIONS with the next version
+number. Steps must be idempotent: databases from before versioning run
+every step once, whatever state they are in.
+"""
+import logging
+import time
+import uuid
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from app import db
+from models import SchemaVersion, ShiftRecurrence, ShiftRecurrenceException, SyncTombstone
+
+
+def create_index_online(index):
+    """Create an index on a live table without blocking writers where the database allows it."""
+    if db.engine.dialect.name == 'postgresql':
+        # CONCURRENTLY keeps the table writable but cannot run inside a transaction
+        ddl = str(CreateIndex(index).compile(dialect=db.engine.dialect)).replace('INDEX', 'INDEX CONCURRENTLY', 1)
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql(ddl)
+    else:
+        # MySQL (InnoDB) builds secondary indexes in place; SQLite holds its write lock briefly
+        index.create(db.engine)
+
+
+def add_day_note_position():
+    """Add day_notes.position (added in v1.0.9)."""
+    inspector = inspect(db.engine)
+    if 'day_notes' not in inspector.get_table_names():
+        return
+    columns = [col['name'] for col in inspector.get_columns('day_notes')]
+    if 'position' not in columns:
+        with db.engine.begin() as conn:
+            conn.execute(text("ALTER TABLE day_notes ADD COLUMN position VARCHAR(20) DEFAULT 'top'"))
+            conn.execute(text("UPDATE day_notes SET position = 'top' WHERE position IS NULL"))
+
+
+def add_calendar_feed_version():
+    """Add the ICS feed version columns to calendars (added in v1.1.0)."""
+    inspector = inspect(db.engine)
+    if 'calendars' not in inspector.get_table_names():
+        return
+    columns = [col['name'] for col in inspector.get_columns('calendars')]
+    if 'feed_version' not in columns:
+        datetime_type = 'DATETIME' if db.engine.dialect.name == 'mysql' else 'TIMESTAMP'
+        with db.engine.begin() as conn:
+            conn.execute(text("ALTER TABLE calendars ADD COLUMN feed_version INTEGER DEFAULT 0"))
+            conn.execute(text(f"ALTER TABLE calendars ADD COLUMN feed_updated_at {datetime_type}"))
+            conn.execute(text("UPDATE calendars SET feed_version = 0 WHERE feed_version IS NULL"))
+            conn.execute(text("UPDATE calendars SET feed_updated_at = updated_at WHERE feed_updated_at IS NULL"))
+
+
+def add_unique_shift_position():
+    """Compact shift positions and enforce one shift per calendar, day and position (added in v1.1.0)."""
+    inspector = inspect(db.engine)
+    if 'shifts' not in inspector.get_table_names():
+        return
+    index_names = {index['name'] for index in inspector.get_indexes('shifts')}
+    if 'uq_shifts_calendar_date_position' in index_names:
+        return
+    with db.engine.begin() as conn:
+        rows = conn.execute(text(
+            "SELECT id, calendar_id, shift_date, position FROM shifts "
+            "ORDER BY calendar_id, shift_date, position, created_at"
+        )).all()
+        updates = []
+        day = None
+        for row in rows:
+            if (row.calendar_id, row.shift_date) != day:
+                day = (row.calendar_id, row.shift_date)
+                expected = 0
+            if row.position != expected:
+                updates.append({'id': row.id, 'position': expected})
+            expected += 1
+        if updates:
+            conn.execute(text("UPDATE shifts SET position = :position WHERE id = :id"), updates)
+    unique_index = next(i for i in db.metadata.tables['shifts'].indexes if i.name == 'uq_shifts_calendar_date_position')
+    create_index_online(unique_index)
+    if 'ix_shifts_calendar_date_position' in index_names:
+        with db.engine.begin() as conn:
+            conn.execute(text("DROP INDEX ix_shifts_calendar_date_position" + (" ON shifts" if db.engine.dialect.name == 'mysql' else "")))
+
+
+def create_missing_indexes():
+    """Create indexes declared on the models that older installs are missing (added in v1.1.0)."""
+    inspector = inspect(db.engine)
+    table_names = inspector.get_table_names()
+    for table in db.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        columns = {col['name'] for col in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            # Indexes on columns a later migration adds are created by that migration
+            if index.name not in existing and {col.name for col in index.columns} <= columns:
+                logging.info(f"Creating index {index.name} on {table.name}...")
+                create_index_online(index)
+
+
+def create_recurrence_tables():
+    """Create the recurring shift tables (added in v1.1.0)."""
+    ShiftRecurrence.__table__.create(db.engine, checkfirst=True)
+    ShiftRecurrenceException.__table__.create(db.engine, checkfirst=True)
+
+
+def add_sync_tracking():
+    """Add the delta sync columns and the sync_tombstones table (added in v1.1.0)."""
+    inspector = inspect(db.engine)
+    table_names = inspector.get_table_names()
+    added = [('shifts', 'sync_version'), ('day_notes', 'sync_version'),
+             ('shift_recurrences', 'sync_version'), ('calendars', 'sync_floor')]
+    for table, column in added:
+        if table not in table_names:
+            continue
+        if column not in [col['name'] for col in inspector.get_columns(table)]:
+            with db.engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER DEFAULT 0"))
+                conn.execute(text(f"UPDATE {table} SET {column} = 0 WHERE {column} IS NULL"))
+    SyncTombstone.__table__.create(db.engine, checkfirst=True)
+    create_missing_indexes()
+
+
+def orphan_cleanup_statements():
+    """SQL removing rows whose parent row is gone, parents first, so enforced foreign keys accept the data."""
+    for table in db.metadata.sorted_tables:
+        for fk in table.foreign_keys:
+            column, referred = fk.parent.name, fk.column
+            where = f"{column} IS NOT NULL AND {column} NOT IN (SELECT {referred.name} FROM {referred.table.name})"
+            if fk.ondelete == 'SET NULL':
+                yield f"UPDATE {table.name} SET {column} = NULL WHERE {where}"
+            else:
+                yield f"DELETE FROM {table.name} WHERE {where}"
+
+
+def rebuild_sqlite_tables(tables):
+    """Recreate SQLite tables from the models, keeping their rows.
+
+    SQLite cannot alter a foreign key, so each table is copied into a new
+    one and renamed back. Foreign key enforcement is off meanwhile, as
+    dropping the old table would otherwise cascade into its children.
+    """
+    dialect = db.engine.dialect
+    raw = db.engine.raw_connection()
+    connection = raw.driver_connection
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    cursor = connection.cursor()
+    try:
+        cursor.execute("PRAGMA foreign_keys = OFF")
+        cursor.execute("BEGIN")
+        for statement in orphan_cleanup_statements():
+            cursor.execute(statement)
+        for table in tables:
+            columns = ', '.join(column.name for column in table.columns)
+            create = str(CreateTable(table).compile(dialect=dialect)).strip()
+            cursor.execute(create.replace(f"CREATE TABLE {table.name} ", f"CREATE TABLE {table.name}__new ", 1))
+            cursor.execute(f"INSERT INTO {table.name}__new ({columns}) SELECT {columns} FROM {table.name}")
+            cursor.execute(f"DROP TABLE {table.name}")
+            cursor.execute(f"ALTER TABLE {table.name}__new RENAME TO {table.name}")
+            for index in table.indexes:
+                cursor.execute(str(CreateIndex(index).compile(dialect=dialect)))
+        violations = cursor.execute("PRAGMA foreign_key_check").fetchall()
+        if violations:
+            raise RuntimeError(f"Foreign key violations after rebuilding tables: {violations[:5]}")
+        cursor.execute("COMMIT")
+    except Exception:
+        if connection.in_transaction:
+            cursor.execute("ROLLBACK")
+        raise
+    finally:
+        cursor.execute("PRAGMA foreign_keys = ON")
+        cursor.close()
+        connection.isolation_level = isolation_level
+        raw.close()
+
+
+def add_foreign_key_cascades():
+    """Move user, calendar, template and recurrence deletes to ON DELETE rules in the database (added in v1.1.0)."""
+    inspector = inspect(db.engine)
+    pending = []
+    for table in db.metadata.sorted_tables:
+        reflected = {tuple(fk['constrained_columns']): fk for fk in inspector.get_foreign_keys(table.name)}
+        for fk in table.foreign_keys:
+            existing = reflected.get((fk.parent.name,))
+            current = ((existing or {}).get('options') or {}).get('ondelete')
+            if fk.ondelete and (current or '').upper() != fk.ondelete:
+                pending.append((table, fk, existing))
+    if not pending:
+        return
+    if db.engine.dialect.name == 'sqlite':
+        rebuild_sqlite_tables(list(dict.fromkeys(table for table, _, _ in pending)))
+        return
+    drop = 'FOREIGN KEY' if db.engine.dialect.name == 'mysql' else 'CONSTRAINT'
+    with db.engine.begin() as conn:
+        for statement in orphan_cleanup_statements():
+            conn.execute(text(statement))
+        for table, fk, existing in pending:
+            name = existing['name'] if existing and existing.get('name') else f"fk_{table.name}_{fk.parent.name}"
+            if existing:
+                conn.execute(text(f"ALTER TABLE {table.name} DROP {drop} {name}"))
+            conn.execute(text(
+                f"ALTER TABLE {table.name} ADD CONSTRAINT {name} FOREIGN KEY ({fk.parent.name}) "
+                f"REFERENCES {fk.column.table.name} ({fk.column.name}) ON DELETE {fk.ondelete}"
+            ))
+
+
+def add_user_feed_tokens():
+    """Add users.feed_token for the merged all-calendars feeds (added in v1.1.0)."""
+    inspector = inspect(db.engine)
+    if 'users' not in inspector.get_table_names():
+        return
+    if 'feed_token' not in [col['name'] for col in inspector.get_columns('users')]:
+        with db.engine.begin() as conn:
+            conn.execute(text("ALTER TABLE users ADD COLUMN feed_token VARCHAR(64)"))
+    with db.engine.begin() as conn:
+        user_ids = conn.execute(text("SELECT id FROM users WHERE feed_token IS NULL")).scalars().all()
+        if user_ids:
+            conn.execute(text("UPDATE users SET feed_token = :token WHERE id = :id"),
+                         [{'id': user_id, 'token': str(uuid.uuid4()).replace('-', '')} for user_id in user_ids])
+    create_missing_indexes()
+
+
+MIGRATIONS = [
+    (1, 'Add day_notes.position', add_day_note_position),
+    (2, 'Add calendars.feed_version and feed_updated_at', add_calendar_feed_version),
+    (3, 'Unique shift position per calendar and day', add_unique_shift_position),
+    (4, 'Create lookup indexes', create_missing_indexes),
+    (5, 'Add recurring shifts', create_recurrence_tables),
+    (6, 'Add delta sync tracking', add_sync_tracking),
+    (7, 'Cascade deletes in the database', add_foreign_key_cascades),
+    (8, 'Add user feed tokens', add_user_feed_tokens),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version():
+    """Return the applied schema version, or None if the database is not versioned yet."""
+    try:
+        with db.engine.connect() as conn:
+            return conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+    except (OperationalError, ProgrammingError):
+        return None
+
+
+def record_version(version, description):
+    with db.engine.begin() as conn:
+        conn.execute(SchemaVersion.__table__.insert().values(version=version, description=description))
+
+
+def migrate():
+    """Bring the database up to SCHEMA_VERSION."""
+    started = time.monotonic()
+    version = current_version()
+    if version is None:
+        if 'users' not in inspect(db.engine).get_table_names():
+            # Fresh database: the models already describe the latest schema
+            db.create_all()
+            record_version(SCHEMA_VERSION, 'Initial schema')
+            logging.info(f"Database created at schema version {SCHEMA_VERSION}")
+            return
+        SchemaVersion.__table__.create(db.engine, checkfirst=True)
+        version = 0
+        logging.info("Existing database is not versioned yet, checking all migrations...")
+
+    for step_version, description, step in MIGRATIONS:
+        if step_version <= version:
+            continue
+        logging.info(f"Migrating database to version {step_version}: {description}...")
+        step()
+        record_version(step_version, description)
+        logging.info(f"Migration {step_version} complete")
+    if version < SCHEMA_VERSION:
+        # Tables that are new since the database was created
+        db.create_all()
+        logging.info(f"Database migrated to schema version {SCHEMA_VERSION} in {time.monotonic() - started:.2f}s")
+
+
+def check_schema():
+    """Verify the schema version at worker startup, migrating only if run.sh did not."""
+    version = current_version()
+    if version is not None and version >= SCHEMA_VERSION:
+        if version > SCHEMA_VERSION:
+            logging.warning(f"Database schema version {version} is newer than this release ({SCHEMA_VERSION})")
+        return
+    migrate()
@@ -1,5 +1,7 @@
 from datetime import datetime
 import uuid
+from sqlalchemy import event
+from sqlalchemy.orm import attributes
 from app import db
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -11,38 +13,50 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=True)
+    feed_token = db.Column(db.String(64), default=lambda: str(uuid.uuid4()).replace('-', ''))
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     
-    calendars = db.relationship('Calendar', backref='owner', lazy=True, cascade='all, delete-orphan')
-    templates = db.relationship('ShiftTemplate', backref='owner', lazy=True, cascade='all, delete-orphan')
+    calendars = db.relationship('Calendar', backref='owner', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
+    templates = db.relationship('ShiftTemplate', backref='owner', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
     
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
     
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
+    
+    __table_args__ = (
+        db.Index('uq_users_feed_token', 'feed_token', unique=True),
+    )
 
 
 class Calendar(db.Model):
     __tablename__ = 'calendars'
     id = db.Column(db.String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = db.Column(db.String, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.String, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text, nullable=True)
     color = db.Column(db.String(7), default='#3788d8')
     api_key = db.Column(db.String(64), unique=True, default=lambda: str(uuid.uuid4()).replace('-', ''))
     is_default = db.Column(db.Boolean, default=False)
+    feed_version = db.Column(db.Integer, default=0)
+    feed_updated_at = db.Column(db.DateTime, default=datetime.now)
+    sync_floor = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     
-    shifts = db.relationship('Shift', backref='calendar', lazy=True, cascade='all, delete-orphan')
+    shifts = db.relationship('Shift', backref='calendar', lazy=True, cascade='all, delete-orphan', passive_deletes=True)
+    
+    __table_args__ = (
+        db.Index('ix_calendars_user_id', 'user_id'),
+    )
 
 
 class ShiftTemplate(db.Model):
     __tablename__ = 'shift_templates'
     id = db.Column(db.String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id = db.Column(db.String, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.String, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     name = db.Column(db.String(100), nullable=False)
     start_time = db.Column(db.Time, nullable=False)
     end_time = db.Column(db.Time, nullable=False)
@@ -50,37 +64,198 @@ class ShiftTemplate(db.Model):
     description = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    
+    __table_args__ = (
+        db.Index('ix_shift_templates_user_id', 'user_id'),
+    )
 
 
 class Shift(db.Model):
     __tablename__ = 'shifts'
     id = db.Column(db.String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    calendar_id = db.Column(db.String, db.ForeignKey('calendars.id'), nullable=False)
-    template_id = db.Column(db.String, db.ForeignKey('shift_templates.id'), nullable=True)
+    calendar_id = db.Column(db.String, db.ForeignKey('calendars.id', ondelete='CASCADE'), nullable=False)
+    template_id = db.Column(db.String, db.ForeignKey('shift_templates.id', ondelete='SET NULL'), nullable=True)
     title = db.Column(db.String(200), nullable=False)
     shift_date = db.Column(db.Date, nullable=False)
     start_time = db.Column(db.Time, nullable=False)
     end_time = db.Column(db.Time, nullable=False)
     color = db.Column(db.String(7), default='#3788d8')
     position = db.Column(db.Integer, default=0)
+    sync_version = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     
-    template = db.relationship('ShiftTemplate', backref='shifts')
+    template = db.relationship('ShiftTemplate', backref=db.backref('shifts', passive_deletes=True))
+    
+    __table_args__ = (
+        db.Index('uq_shifts_calendar_date_position', 'calendar_id', 'shift_date', 'position', unique=True),
+        db.Index('ix_shifts_template_id', 'template_id'),
+        db.Index('ix_shifts_calendar_sync_version', 'calendar_id', 'sync_version'),
+    )
 
 
 class DayNote(db.Model):
     __tablename__ = 'day_notes'
     id = db.Column(db.String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    calendar_id = db.Column(db.String, db.ForeignKey('calendars.id'), nullable=False)
+    calendar_id = db.Column(db.String, db.ForeignKey('calendars.id', ondelete='CASCADE'), nullable=False)
     note_date = db.Column(db.Date, nullable=False)
     content = db.Column(db.Text, nullable=False)
     position = db.Column(db.String(10), default='top')
+    sync_version = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     
-    calendar = db.relationship('Calendar', backref=db.backref('day_notes', lazy=True, cascade='all, delete-orphan'))
+    calendar = db.relationship('Calendar', backref=db.backref('day_notes', lazy=True, cascade='all, delete-orphan', passive_deletes=True))
     
     __table_args__ = (
         db.UniqueConstraint('calendar_id', 'note_date', name='unique_calendar_date_note'),
+        db.Index('ix_day_notes_calendar_sync_version', 'calendar_id', 'sync_version'),
+    )
+
+
+class ShiftRecurrence(db.Model):
+    __tablename__ = 'shift_recurrences'
+    id = db.Column(db.String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    calendar_id = db.Column(db.String, db.ForeignKey('calendars.id', ondelete='CASCADE'), nullable=False)
+    template_id = db.Column(db.String, db.ForeignKey('shift_templates.id', ondelete='CASCADE'), nullable=False)
+    rrule = db.Column(db.String(500), nullable=False)
+    dtstart = db.Column(db.Date, nullable=False)
+    sync_version = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    
+    calendar = db.relationship('Calendar', backref=db.backref('recurrences', lazy=True, cascade='all, delete-orphan', passive_deletes=True))
+    template = db.relationship('ShiftTemplate', backref=db.backref('recurrences', lazy=True, cascade='all, delete-orphan', passive_deletes=True))
+    exceptions = db.relationship('ShiftRecurrenceException', backref='recurrence', lazy='selectin', cascade='all, delete-orphan', passive_deletes=True)
+    
+    __table_args__ = (
+        db.Index('ix_shift_recurrences_calendar_id', 'calendar_id'),
+        db.Index('ix_shift_recurrences_template_id', 'template_id'),
+    )
+
+
+class ShiftRecurrenceException(db.Model):
+    __tablename__ = 'shift_recurrence_exceptions'
+    id = db.Column(db.String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    recurrence_id = db.Column(db.String, db.ForeignKey('shift_recurrences.id', ondelete='CASCADE'), nullable=False)
+    exception_date = db.Column(db.Date, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    
+    __table_args__ = (
+        db.UniqueConstraint('recurrence_id', 'exception_date', name='unique_recurrence_exception_date'),
+    )
+
+
+class SyncTombstone(db.Model):
+    """Records a deleted shift, note, recurrence or occurrence for delta sync clients."""
+    __tablename__ = 'sync_tombstones'
+    id = db.Column(db.Integer, primary_key=True)
+    calendar_id = db.Column(db.String, db.ForeignKey('calendars.id', ondelete='CASCADE'), nullable=False)
+    entity_type = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.String(100), nullable=False)
+    entity_date = db.Column(db.Date, nullable=True)
+    sync_version = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.now)
+    
+    __table_args__ = (
+        db.Index('ix_sync_tombstones_calendar_version', 'calendar_id', 'sync_version'),
     )
+
+
+class SchemaVersion(db.Model):
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.now)
+
+
+@event.listens_for(db.session, 'before_flush')
+def bump_feed_versions(session, flush_context, instances):
+    """Bump feed_version on every calendar affected by this flush and stamp the changes with it.
+    
+    The bumped feed_version doubles as the delta sync counter: changed
+    shifts, notes and recurrences get it as their sync_version, and
+    deletions leave a SyncTombstone carrying it.
+    """
+    from recurrence import occurrence_id
+    
+    calendar_ids = set()
+    template_user_ids = set()
+    template_ids = set()
+    deleted_template_ids = set()
+    stamped = []
+    tombstones = []
+    deleted_calendar_ids = {o.id for o in session.deleted if isinstance(o, Calendar)}
+    changed = list(session.new) + [o for o in session.dirty if session.is_modified(o)] + list(session.deleted)
+    for obj in changed:
+        if isinstance(obj, (Shift, DayNote)):
+            calendar_ids.add(obj.calendar_id)
+            if obj in session.deleted:
+                entity_type, entity_date = ('event', obj.shift_date) if isinstance(obj, Shift) else ('note', obj.note_date)
+                tombstones.append((obj.calendar_id, entity_type, obj.id, entity_date))
+            else:
+                stamped.append(obj)
+        elif isinstance(obj, ShiftRecurrence):
+            calendar_ids.add(obj.calendar_id)
+            if obj in session.deleted:
+                tombstones.append((obj.calendar_id, 'recurrence', obj.id, None))
+            elif (obj in session.new or session.is_modified(obj, include_collections=False)
+                  or attributes.get_history(obj, 'exceptions').deleted):
+                # Restored dates come back by re-sending the whole recurrence
+                stamped.append(obj)
+        elif isinstance(obj, ShiftRecurrenceException):
+            with session.no_autoflush:
+                recurrence = obj.recurrence
+            if recurrence is not None:
+                calendar_ids.add(recurrence.calendar_id)
+                if obj in session.new:
+                    tombstones.append((recurrence.calendar_id, 'event', occurrence_id(recurrence.id, obj.exception_date), obj.exception_date))
+                elif obj in session.deleted:
+                    stamped.append(recurrence)
+        elif isinstance(obj, ShiftTemplate) and obj not in session.new:
+            template_user_ids.add(obj.user_id)
+            template_ids.add(obj.id)
+            if obj in session.deleted:
+                deleted_template_ids.add(obj.id)
+        elif isinstance(obj, Calendar) and obj not in session.new and obj not in session.deleted:
+            calendar_ids.add(obj.id)
+    
+    calendars = Calendar.__table__
+    if template_user_ids:
+        rows = session.execute(db.select(calendars.c.id).where(calendars.c.user_id.in_(template_user_ids)))
+        calendar_ids.update(row.id for row in rows)
+    calendar_ids.discard(None)
+    if calendar_ids:
+        session.execute(
+            calendars.update()
+            .where(calendars.c.id.in_(calendar_ids))
+            .values(feed_version=db.func.coalesce(calendars.c.feed_version, 0) + 1, feed_updated_at=datetime.now())
+        )
+        versions = dict(session.execute(
+            db.select(calendars.c.id, calendars.c.feed_version).where(calendars.c.id.in_(calendar_ids))
+        ).all())
+        for obj in stamped:
+            obj.sync_version = versions.get(obj.calendar_id)
+        for calendar_id, entity_type, entity_id, entity_date in tombstones:
+            if calendar_id not in deleted_calendar_ids and calendar_id in versions:
+                session.add(SyncTombstone(calendar_id=calendar_id, entity_type=entity_type, entity_id=entity_id,
+                                          entity_date=entity_date, sync_version=versions[calendar_id]))
+        if deleted_template_ids:
+            # The database deletes the recurrences of a deleted template without loading them
+            recurrences = ShiftRecurrence.__table__
+            session.execute(SyncTombstone.__table__.insert().from_select(
+                ['calendar_id', 'entity_type', 'entity_id', 'sync_version', 'deleted_at'],
+                db.select(recurrences.c.calendar_id, db.literal('recurrence'), recurrences.c.id,
+                          calendars.c.feed_version, db.literal(datetime.now()))
+                .join(calendars, calendars.c.id == recurrences.c.calendar_id)
+                .where(recurrences.c.template_id.in_(deleted_template_ids))
+            ))
+        for table in (Shift.__table__, ShiftRecurrence.__table__):
+            if template_ids:
+                # Edited and deleted templates change how their shifts display
+                session.execute(
+                    table.update()
+                    .where(table.c.template_id.in_(template_ids))
+                    .values(sync_version=db.select(calendars.c.feed_version)
+                            .where(calendars.c.id == table.c.calendar_id).scalar_subquery())
+                )
@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from app import app, db, WEB_THREADS
+from models import Calendar
+from sync import change_summary
+
+PUSH_POLL_INTERVAL = float(os.environ.get("PUSH_POLL_INTERVAL", "1"))
+PUSH_HEARTBEAT_SECONDS = float(os.environ.get("PUSH_HEARTBEAT_SECONDS", "15"))
+PUSH_STREAM_SECONDS = float(os.environ.get("PUSH_STREAM_SECONDS", "300"))
+PUSH_RETRY_MS = int(os.environ.get("PUSH_RETRY_MS", "3000"))
+# Every open stream holds a worker thread, so leave at least half of them for normal requests
+PUSH_MAX_STREAMS = int(os.environ.get("PUSH_MAX_STREAMS", str(WEB_THREADS // 2)))
+PUSH_QUEUE_SIZE = 100
+
+
+def format_event(event_type, data, event_id=None):
+    """Encode one server-sent event."""
+    lines = [f'event: {event_type}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append('data: ' + json.dumps(data, separators=(',', ':')))
+    return '\n'.join(lines) + '\n\n'
+
+
+def change_event(calendar_id, version, since):
+    """SSE message describing what changed on a calendar between two feed versions."""
+    dates, recurrence_ids = change_summary(calendar_id, since)
+    return format_event('change', {
+        'calendar_id': calendar_id,
+        'sync_token': str(version),
+        'dates': [d.isoformat() for d in dates],
+        'recurrences': recurrence_ids
+    }, event_id=version)
+
+
+class ChangeHub:
+    """Fans calendar changes out to the server-sent event streams of this worker.
+
+    Writes can happen in any gunicorn worker, so instead of being notified
+    by the routes the hub polls calendars.feed_version, which every write
+    bumps in the same transaction. One background thread per worker runs a
+    single query per interval for all calendars with open streams and builds
+    each change message once, however many streams watch the calendar.
+    """
+
+    def __init__(self, max_streams=PUSH_MAX_STREAMS, interval=PUSH_POLL_INTERVAL):
+        self.max_streams = max_streams
+        self.interval = interval
+        self._subscribers = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, calendar_id, version):
+        """Register a stream for a calendar whose client has seen version.
+        
+        Returns (queue, version) where version is the one the hub publishes
+        changes from, or None when this worker has no stream slot left.
+        """
+        with self._lock:
+            if sum(len(queues) for queues in self._subscribers.values()) >= self.max_streams:
+                return None
+            messages = queue.Queue(maxsize=PUSH_QUEUE_SIZE)
+            self._subscribers.setdefault(calendar_id, set()).add(messages)
+            self._versions.setdefault(calendar_id, version)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='change-hub', daemon=True)
+                self._thread.start()
+            return messages, self._versions[calendar_id]
+
+    def unsubscribe(self, calendar_id, messages):
+        with self._lock:
+            queues = self._subscribers.get(calendar_id)
+            if queues is None:
+                return
+            queues.discard(messages)
+            if not queues:
+                del self._subscribers[calendar_id]
+                self._versions.pop(calendar_id, None)
+
+    def _publish(self, calendar_id, message):
+        with self._lock:
+            queues = list(self._subscribers.get(calendar_id, ()))
+        for messages in queues:
+            try:
+                messages.put_nowait(message)
+            except queue.Full:
+                # A stalled client misses this message; the next one carries a newer sync_token
+                pass
+
+    def poll(self):
+        """Check the watched calendars once and publish their changes."""
+        with self._lock:
+            watched = dict(self._versions)
+        if not watched:
+            return
+        with app.app_context():
+            try:
+                current = dict(db.session.query(Calendar.id, Calendar.feed_version)
+                               .filter(Calendar.id.in_(watched)).all())
+                for calendar_id, seen in watched.items():
+                    if calendar_id not in current:
+                        self._publish(calendar_id, None)
+                        continue
+                    version = current[calendar_id] or 0
+                    if version <= seen:
+                        continue
+                    message = change_event(calendar_id, version, seen)
+                    with self._lock:
+                        if calendar_id in self._versions:
+                            self._versions[calendar_id] = version
+                    self._publish(calendar_id, message)
+            finally:
+                db.session.remove()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception:
+                logging.exception("Change hub poll failed")
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+
+
+change_hub = ChangeHub()
+
+
+def stream_messages(calendar_id, messages, first):
+    """Yield SSE text for one client until the stream times out or its calendar is deleted.
+
+    Streams end after PUSH_STREAM_SECONDS and the browser reconnects with
+    Last-Event-ID, so worker threads are handed back regularly.
+    """
+    try:
+        yield f'retry: {PUSH_RETRY_MS}\n\n'
+        yield first
+        deadline = time.monotonic() + PUSH_STREAM_SECONDS
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                message = messages.get(timeout=min(PUSH_HEARTBEAT_SECONDS, remaining))
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if message is None:
+                yield format_event('deleted', {'calendar_id': calendar_id})
+                return
+            yield message
+    finally:
+        change_hub.unsubscribe(calendar_id, messages)
@@ -0,0 +1,67 @@
+"""Column-only read queries.
+
+Listings only need a handful of columns per shift or note, so these
+helpers select them as plain rows instead of hydrating ORM instances
+(with their timestamps, relationships and identity-map bookkeeping).
+Rows keep the model attribute names, so code written against Shift
+objects, such as expand_recurrences, accepts them too.
+"""
+from sqlalchemy import case
+
+from app import db
+from models import Calendar, DayNote, Shift, ShiftTemplate
+
+
+def display_column(template_column, shift_column):
+    """The template's value for templated shifts, the shift's own otherwise, as get_shift_display_values does."""
+    return case((ShiftTemplate.id.isnot(None), template_column), else_=shift_column)
+
+
+def user_calendar_ids(user_id):
+    return db.select(Calendar.id).where(Calendar.user_id == user_id)
+
+
+def shift_rows(*criteria, yield_per=None):
+    """Shifts matching criteria with their display values, ordered by date and position.
+    
+    With yield_per the rows are fetched from the cursor in batches of that
+    size instead of all at once.
+    """
+    query = (
+        db.select(
+            Shift.id,
+            Shift.calendar_id,
+            Shift.shift_date,
+            Shift.position,
+            Shift.template_id,
+            display_column(ShiftTemplate.name, Shift.title).label('title'),
+            display_column(ShiftTemplate.start_time, Shift.start_time).label('start_time'),
+            display_column(ShiftTemplate.end_time, Shift.end_time).label('end_time'),
+            display_column(ShiftTemplate.color, Shift.color).label('color'),
+        )
+        .outerjoin(ShiftTemplate, ShiftTemplate.id == Shift.template_id)
+        .where(*criteria)
+        .order_by(Shift.shift_date, Shift.position)
+    )
+    if yield_per:
+        return db.session.execute(query.execution_options(yield_per=yield_per))
+    return db.session.execute(query).all()
+
+
+def note_rows(*criteria):
+    """Day notes matching criteria, ordered by date."""
+    query = (
+        db.select(DayNote.id, DayNote.calendar_id, DayNote.note_date, DayNote.content, DayNote.position)
+        .where(*criteria)
+        .order_by(DayNote.note_date)
+    )
+    return db.session.execute(query).all()
+
+
+def window_criteria(column, start_date, end_date):
+    criteria = []
+    if start_date:
+        criteria.append(column >= start_date)
+    if end_date:
+        criteria.append(column <= end_date)
+    return criteria
@@ -0,0 +1,121 @@
+from collections import Counter, namedtuple
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+import os
+
+from dateutil.rrule import rrulestr
+
+from models import ShiftRecurrence
+
+RECURRENCE_HORIZON_DAYS = int(os.environ.get("RECURRENCE_HORIZON_DAYS", "366"))
+# Stored and recurring shifts together; shift_service enforces it on writes
+MAX_SHIFTS_PER_DAY = 2
+ALLOWED_FREQUENCIES = ('DAILY', 'WEEKLY', 'MONTHLY', 'YEARLY')
+OCCURRENCE_SEPARATOR = ':'
+
+Occurrence = namedtuple('Occurrence', ['id', 'recurrence', 'date', 'position'])
+
+
+def normalize_rrule(text):
+    """Validate an RRULE body such as FREQ=WEEKLY;BYDAY=MO,TU and return it in canonical form."""
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError('rrule is required')
+    body = text.strip().upper()
+    if body.startswith('RRULE:'):
+        body = body[len('RRULE:'):]
+    if '\n' in body or 'DTSTART' in body:
+        raise ValueError('rrule must be a single RRULE without DTSTART')
+    parts = dict(part.split('=', 1) for part in body.split(';') if '=' in part)
+    if parts.get('FREQ') not in ALLOWED_FREQUENCIES:
+        raise ValueError(f"FREQ must be one of {', '.join(ALLOWED_FREQUENCIES)}")
+    rrulestr(body, dtstart=datetime(2000, 1, 1))
+    return body
+
+
+@lru_cache(maxsize=1024)
+def build_rule(rrule, dtstart):
+    return rrulestr(rrule, dtstart=datetime.combine(dtstart, time.min))
+
+
+def occurrence_dates(recurrence, start_date=None, end_date=None):
+    """Dates the recurrence falls on within the window, without its exception dates.
+
+    An open end is capped at RECURRENCE_HORIZON_DAYS from today so rules
+    without COUNT or UNTIL stay finite.
+    """
+    start_date = max(start_date or recurrence.dtstart, recurrence.dtstart)
+    end_date = end_date or date.today() + timedelta(days=RECURRENCE_HORIZON_DAYS)
+    if end_date < start_date:
+        return []
+    rule = build_rule(recurrence.rrule, recurrence.dtstart)
+    skipped = {e.exception_date for e in recurrence.exceptions}
+    dates = {d.date() for d in rule.between(datetime.combine(start_date, time.min),
+                                            datetime.combine(end_date, time.min), inc=True)}
+    return sorted(dates - skipped)
+
+
+def occurs_on(recurrence, day):
+    return bool(occurrence_dates(recurrence, day, day))
+
+
+def expand_recurrences(recurrences, start_date=None, end_date=None, shifts=()):
+    """Expand recurrences into occurrences, placed after the stored shifts of each day.
+
+    Occurrences that would take a day past MAX_SHIFTS_PER_DAY are left out.
+    Writes keep days within the limit, so these only appear where an open
+    rule meets shifts beyond the horizon it was checked against.
+    """
+    taken = Counter((s.calendar_id, s.shift_date) for s in shifts)
+    expanded = [(day, recurrence) for recurrence in recurrences
+                for day in occurrence_dates(recurrence, start_date, end_date)]
+    expanded.sort(key=lambda item: (item[0], item[1].created_at or datetime.min, item[1].id))
+    occurrences = []
+    for day, recurrence in expanded:
+        key = (recurrence.calendar_id, day)
+        if taken[key] >= MAX_SHIFTS_PER_DAY:
+            continue
+        occurrences.append(Occurrence(occurrence_id(recurrence.id, day), recurrence, day, taken[key]))
+        taken[key] += 1
+    return occurrences
+
+
+def occurrence_id(recurrence_id, day):
+    return f'{recurrence_id}{OCCURRENCE_SEPARATOR}{day.isoformat()}'
+
+
+def parse_occurrence_id(event_id):
+    """Split an occurrence id into (recurrence_id, date), or return None for a stored shift id or a non-string."""
+    if not isinstance(event_id, str):
+        return None
+    recurrence_id, _, day = event_id.rpartition(OCCURRENCE_SEPARATOR)
+    if not recurrence_id:
+        return None
+    try:
+        return recurrence_id, date.fromisoformat(day)
+    except ValueError:
+        return None
+
+
+def count_occurrences(calendar_id, day):
+    """Number of recurring shifts a calendar has on a day."""
+    recurrences = ShiftRecurrence.query.filter(
+        ShiftRecurrence.calendar_id == calendar_id,
+        ShiftRecurrence.dtstart <= day
+    ).all()
+    return sum(1 for r in recurrences if occurs_on(r, day))
+
+
+def rotation_rules(pattern):
+    """Turn an on/off rotation into one (dtstart, rrule) per working day of the cycle."""
+    start_date = datetime.strptime(pattern['start'], '%Y-%m-%d').date()
+    on_days = int(pattern.get('on', 1))
+    off_days = int(pattern.get('off', 0))
+    if on_days < 1 or off_days < 0:
+        raise ValueError('Rotation needs at least one working day')
+    until = ''
+    if pattern.get('end'):
+        until = ';UNTIL=' + datetime.strptime(pattern['end'], '%Y-%m-%d').strftime('%Y%m%d')
+    if off_days == 0:
+        return [(start_date, f'FREQ=DAILY{until}')]
+    cycle = on_days + off_days
+    return [(start_date + timedelta(days=i), f'FREQ=DAILY;INTERVAL={cycle}{until}') for i in range(on_days)]
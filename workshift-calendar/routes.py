@@ -1,28 +1,79 @@
-from flask import render_template, request, jsonify, session, Response, redirect, url_for, flash
+from flask import render_template, request, jsonify, session, Response, redirect, url_for, flash, stream_with_context, g, abort
+from collections import Counter
+from itertools import islice
 from datetime import datetime, timedelta, date
-from app import app, db
-from local_auth import require_login
+from app import app, db, METRICS_ENABLED
+from local_auth import require_login, get_cached_user
 from flask_login import current_user, login_user, logout_user
-from models import Calendar, ShiftTemplate, Shift, User, DayNote
-from icalendar import Calendar as ICalendar, Event as ICalEvent
+from models import Calendar, ShiftTemplate, Shift, User, DayNote, ShiftRecurrence
+from feed_cache import event_cache
+from cache import CalendarRef, api_key_cache, user_cache
+from shift_service import (MAX_SHIFTS_PER_DAY, run_in_transaction, add_shift, delete_shift, move_shift, set_day_note,
+                           count_day_shifts, skip_occurrence, detach_occurrence, skip_full_days, lock_calendar)
+from recurrence import (build_rule, count_occurrences, expand_recurrences, normalize_rrule, occurrence_dates, occurs_on,
+                        parse_occurrence_id, rotation_rules)
+from sync import SyncTokenExpired, changes_since, current_sync_state, parse_sync_token, prune_tombstones
+from push import change_event, change_hub, format_event, stream_messages
+from queries import note_rows, shift_rows, user_calendar_ids, window_criteria
+from compact import encode_events, encode_notes, encode_shifts, wants_compact
+from compression import compress_response
+from caching import apply_cache_policy, no_store, static_fingerprint
+from backup import BackupError, export_records, import_records
+from icalendar import Calendar as ICalendar, Event as ICalEvent, vRecur
+from werkzeug.http import is_resource_modified
+import metrics
+import hashlib
+import hmac
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 import os
+import uuid
+
+ICS_STREAM_BATCH_SIZE = 500
+MAX_BULK_SHIFTS = 1000
+MAX_WEBHOOK_ACTIONS = 500
+ADMIN_MODE = os.environ.get('ADMIN_MODE', '').lower() == 'true'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+CACHES = {'api_key': api_key_cache, 'user': user_cache}
+for stat in ('hits', 'misses', 'evictions'):
+    metrics.registry.register_counter(
+        f'workshift_cache_{stat}_total', f'Process cache {stat}', 'cache',
+        lambda stat=stat: {name: cache.stats()[stat] for name, cache in CACHES.items()}
+    )
 
 def is_admin_mode():
-    admin_enabled = os.environ.get('ADMIN_MODE', '').lower() == 'true'
-    is_ingress = bool(request.headers.get('X-Ingress-Path'))
-    return admin_enabled and is_ingress
+    if 'admin_mode' not in g:
+        g.admin_mode = ADMIN_MODE and bool(request.headers.get('X-Ingress-Path'))
+    return g.admin_mode
 
 def get_view_user():
-    if is_admin_mode() and current_user.is_authenticated:
-        view_user_id = session.get('admin_view_user_id')
-        if view_user_id:
-            user = User.query.get(view_user_id)
-            if user:
-                return user
-    return current_user if current_user.is_authenticated else None
+    if 'view_user' not in g:
+        g.view_user = current_user if current_user.is_authenticated else None
+        if is_admin_mode() and current_user.is_authenticated:
+            view_user_id = session.get('admin_view_user_id')
+            if view_user_id:
+                user = get_cached_user(view_user_id)
+                if user:
+                    g.view_user = user
+    return g.view_user
+
+def get_calendar_by_api_key(api_key):
+    """Resolve an api_key to a CalendarRef through the process-wide cache, or abort with 404."""
+    ref = api_key_cache.get(api_key)
+    if ref is None:
+        generation = api_key_cache.generation()
+        calendar = Calendar.query.filter_by(api_key=api_key).first_or_404()
+        ref = CalendarRef(calendar.id, calendar.name, calendar.user_id)
+        api_key_cache.set(api_key, ref, generation)
+    return ref
 
 def get_shift_display_values(shift):
-    """Get display values for a shift, using template values if linked."""
+    """Get display values for a shift, using template values if linked.
+    
+    Listing queries should use joinedload(Shift.template) so this does not
+    issue a lazy SELECT per templated shift.
+    """
     if shift.template_id and shift.template:
         return {
             'title': shift.template.name,
@@ -37,6 +88,49 @@ def get_shift_display_values(shift):
         'color': shift.color
     }
 
+def find_occurrence(event_id, calendar_filter):
+    """Resolve an occurrence id to (recurrence, date), or None if it is not a live occurrence."""
+    parsed = parse_occurrence_id(event_id)
+    if parsed is None:
+        return None
+    recurrence_id, day = parsed
+    recurrence = ShiftRecurrence.query.join(Calendar).filter(
+        ShiftRecurrence.id == recurrence_id, calendar_filter
+    ).options(joinedload(ShiftRecurrence.template)).first()
+    if recurrence is None or not occurs_on(recurrence, day):
+        return None
+    return recurrence, day
+
+def load_occurrence(recurrence, day):
+    """Build the Occurrence for one date, positioned among that day's other shifts."""
+    day_shifts = Shift.query.filter_by(calendar_id=recurrence.calendar_id, shift_date=day).all()
+    day_recurrences = ShiftRecurrence.query.filter(
+        ShiftRecurrence.calendar_id == recurrence.calendar_id,
+        ShiftRecurrence.dtstart <= day
+    ).all()
+    occurrence = next((o for o in expand_recurrences(day_recurrences, day, day, day_shifts)
+                       if o.recurrence.id == recurrence.id), None)
+    if occurrence is None:
+        # Left out because its day is already full
+        abort(404)
+    return occurrence
+
+def get_occurrence_values(occurrence):
+    """Shift-shaped values for a recurring occurrence, taken from its template."""
+    template = occurrence.recurrence.template
+    return {
+        'id': occurrence.id,
+        'title': template.name,
+        'date': occurrence.date.isoformat(),
+        'start_time': template.start_time.strftime('%H:%M'),
+        'end_time': template.end_time.strftime('%H:%M'),
+        'color': template.color,
+        'position': occurrence.position,
+        'calendar_id': occurrence.recurrence.calendar_id,
+        'template_id': template.id,
+        'recurrence_id': occurrence.recurrence.id
+    }
+
 
 @app.before_request
 def normalize_path():
@@ -50,9 +144,7 @@ def normalize_path():
 def ingress_auto_login():
     if current_user.is_authenticated:
         return
-    admin_enabled = os.environ.get('ADMIN_MODE', '').lower() == 'true'
-    is_ingress = bool(request.headers.get('X-Ingress-Path'))
-    if admin_enabled and is_ingress:
+    if is_admin_mode():
         user = User.query.first()
         if not user:
             user = User(username='admin')
@@ -66,12 +158,17 @@ def make_session_permanent():
     session.permanent = True
 
 
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        fingerprint = static_fingerprint(values['filename'])
+        if fingerprint:
+            values.setdefault('v', fingerprint)
+
+
 @app.after_request
-def add_cache_control(response):
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
-    return response
+def apply_http_caching(response):
+    return compress_response(apply_cache_policy(response))
 
 
 @app.route('/')
@@ -113,6 +210,7 @@ def index():
 
 
 @app.route('/login', methods=['GET', 'POST'])
+@no_store
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
@@ -132,6 +230,7 @@ def login():
 
 
 @app.route('/register', methods=['GET', 'POST'])
+@no_store
 def register():
     if current_user.is_authenticated:
         return redirect(url_for('index'))
@@ -161,6 +260,7 @@ def register():
 
 
 @app.route('/logout')
+@no_store
 def logout():
     session.pop('admin_view_user_id', None)
     logout_user()
@@ -168,24 +268,26 @@ def logout():
 
 
 @app.route('/admin/switch-user/<user_id>')
+@no_store
 @require_login
 def admin_switch_user(user_id):
     if not is_admin_mode():
         return redirect(url_for('index'))
     
-    user = User.query.get(user_id)
+    user = get_cached_user(user_id)
     if user:
         session['admin_view_user_id'] = user_id
     return redirect(url_for('index'))
 
 
-@app.route('/admin/delete-user/<int:user_id>', methods=['POST'])
+@app.route('/admin/delete-user/<user_id>', methods=['POST'])
+@no_store
 @require_login
 def admin_delete_user(user_id):
     if not is_admin_mode():
         return jsonify({'error': 'Not authorized'}), 403
     
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id)
     if not user:
         return jsonify({'error': 'User not found'}), 404
     
@@ -195,23 +297,36 @@ def admin_delete_user(user_id):
     if session.get('admin_view_user_id') == user_id:
         session.pop('admin_view_user_id', None)
     
-    DayNote.query.filter(DayNote.calendar_id.in_(
-        db.session.query(Calendar.id).filter_by(user_id=user_id)
-    )).delete(synchronize_session=False)
-    
-    Shift.query.filter(Shift.calendar_id.in_(
-        db.session.query(Calendar.id).filter_by(user_id=user_id)
-    )).delete(synchronize_session=False)
-    
-    Calendar.query.filter_by(user_id=user_id).delete()
-    ShiftTemplate.query.filter_by(user_id=user_id).delete()
-    
+    # Calendars, templates and everything in them go with the user through ON DELETE CASCADE
     db.session.delete(user)
     db.session.commit()
+    api_key_cache.invalidate_where(lambda ref: ref.user_id == user_id)
+    user_cache.invalidate(user_id)
     
     return jsonify({'success': True})
 
 
+@app.route('/api/admin/cache-stats')
+@no_store
+@require_login
+def admin_cache_stats():
+    if not is_admin_mode():
+        return jsonify({'error': 'Not authorized'}), 403
+    return jsonify({'api_key_cache': api_key_cache.stats(), 'user_cache': user_cache.stats()})
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape target, available when the metrics option is enabled."""
+    if not METRICS_ENABLED:
+        return jsonify({'error': 'Not found'}), 404
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    response = Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
 @app.route('/templates')
 @require_login
 def templates_page():
@@ -221,6 +336,7 @@ def templates_page():
 
 
 @app.route('/settings')
+@no_store
 @require_login
 def settings_page():
     from app import INGRESS_MODE
@@ -235,10 +351,12 @@ def settings_page():
         external_base_url = "http://<YOUR_HA_IP>:8099"
     else:
         external_base_url = request.url_root.rstrip('/')
-    return render_template('settings.html', user=current_user, view_user=view_user, calendars=calendars, admin_mode=is_admin_mode(), external_base_url=external_base_url, ingress_mode=INGRESS_MODE)
+    feed_token = db.session.query(User.feed_token).filter(User.id == view_user.id).scalar()
+    return render_template('settings.html', user=current_user, view_user=view_user, calendars=calendars, feed_token=feed_token, admin_mode=is_admin_mode(), external_base_url=external_base_url, ingress_mode=INGRESS_MODE)
 
 
 @app.route('/api/calendars', methods=['GET', 'POST'])
+@no_store
 @require_login
 def api_calendars():
     view_user = get_view_user()
@@ -266,6 +384,7 @@ def api_calendars():
 
 
 @app.route('/api/calendars/<calendar_id>', methods=['GET', 'PUT', 'DELETE'])
+@no_store
 @require_login
 def api_calendar(calendar_id):
     view_user = get_view_user()
@@ -286,15 +405,66 @@ def api_calendar(calendar_id):
         calendar.name = data.get('name', calendar.name)
         calendar.description = data.get('description', calendar.description)
         calendar.color = data.get('color', calendar.color)
+        old_api_key = calendar.api_key
+        if data.get('regenerate_api_key'):
+            calendar.api_key = str(uuid.uuid4()).replace('-', '')
         db.session.commit()
-        return jsonify({'success': True})
+        api_key_cache.invalidate(old_api_key)
+        return jsonify({'success': True, 'api_key': calendar.api_key})
     
     if request.method == 'DELETE':
+        api_key = calendar.api_key
         db.session.delete(calendar)
         db.session.commit()
+        api_key_cache.invalidate(api_key)
         return jsonify({'success': True})
 
 
+@app.route('/api/feed-token', methods=['GET', 'POST'])
+@no_store
+@require_login
+def api_feed_token():
+    """The token of the user's merged feeds; POST replaces it, invalidating the old URLs."""
+    user_id = get_view_user().id
+    if request.method == 'POST':
+        feed_token = str(uuid.uuid4()).replace('-', '')
+        User.query.filter_by(id=user_id).update({'feed_token': feed_token})
+        db.session.commit()
+        user_cache.invalidate(user_id)
+        return jsonify({'feed_token': feed_token})
+    return jsonify({'feed_token': db.session.query(User.feed_token).filter(User.id == user_id).scalar()})
+
+
+@app.route('/api/export')
+@no_store
+@require_login
+def api_export():
+    """Download a backup of the user's calendars: NDJSON by default, or one merged ICS feed with ?format=ics."""
+    view_user = get_view_user()
+    stamp = date.today().isoformat()
+    if request.args.get('format') == 'ics':
+        calendar_names = {c.id: c.name for c in Calendar.query.filter_by(user_id=view_user.id)}
+        body = generate_ics_feed(calendar_names, view_user.username, None, None, categories=True)
+        response = Response(stream_with_context(body), mimetype='text/calendar')
+        response.headers['Content-Disposition'] = f'attachment; filename="workshift-{view_user.username}-{stamp}.ics"'
+        return response
+    response = Response(stream_with_context(export_records(view_user.id)), mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = f'attachment; filename="workshift-{view_user.username}-{stamp}.ndjson"'
+    return response
+
+
+@app.route('/api/import', methods=['POST'])
+@require_login
+def api_import():
+    """Restore an NDJSON backup as new calendars and templates, reading the upload as it arrives."""
+    upload = request.files.get('file')
+    try:
+        counts = import_records(get_view_user().id, upload.stream if upload else request.stream)
+    except BackupError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'success': True, 'imported': counts}), 201
+
+
 @app.route('/api/templates', methods=['GET', 'POST'])
 @require_login
 def api_templates():
@@ -367,54 +537,59 @@ def api_shifts():
         start = request.args.get('start')
         end = request.args.get('end')
         
-        query = Shift.query.join(Calendar).filter(Calendar.user_id == view_user.id)
+        criteria = [Shift.calendar_id.in_(user_calendar_ids(view_user.id))]
+        recurrence_query = ShiftRecurrence.query.join(Calendar).filter(Calendar.user_id == view_user.id)
+        start_date = end_date = None
         if calendar_id:
-            query = query.filter(Shift.calendar_id == calendar_id)
+            criteria.append(Shift.calendar_id == calendar_id)
+            recurrence_query = recurrence_query.filter(ShiftRecurrence.calendar_id == calendar_id)
         if start:
             start_date = datetime.fromisoformat(start.replace('Z', '')).date()
-            query = query.filter(Shift.shift_date >= start_date)
         if end:
             end_date = datetime.fromisoformat(end.replace('Z', '')).date()
-            query = query.filter(Shift.shift_date <= end_date)
+            recurrence_query = recurrence_query.filter(ShiftRecurrence.dtstart <= end_date)
         
-        shifts = query.order_by(Shift.shift_date, Shift.position).all()
-        result = []
-        for s in shifts:
-            display = get_shift_display_values(s)
-            result.append({
-                'id': s.id,
-                'title': display['title'],
-                'date': s.shift_date.isoformat(),
-                'start_time': display['start_time'].strftime('%H:%M'),
-                'end_time': display['end_time'].strftime('%H:%M'),
-                'color': display['color'],
-                'position': s.position,
-                'calendar_id': s.calendar_id,
-                'template_id': s.template_id
-            })
+        rows = shift_rows(*criteria, *window_criteria(Shift.shift_date, start_date, end_date))
+        recurrences = recurrence_query.options(joinedload(ShiftRecurrence.template)).all()
+        occurrences = expand_recurrences(recurrences, start_date, end_date, rows) if recurrences else []
+        if wants_compact(request.args):
+            return jsonify(encode_shifts(rows, occurrences))
+        
+        result = [{
+            'id': row.id,
+            'title': row.title,
+            'date': row.shift_date.isoformat(),
+            'start_time': row.start_time.strftime('%H:%M'),
+            'end_time': row.end_time.strftime('%H:%M'),
+            'color': row.color,
+            'position': row.position,
+            'calendar_id': row.calendar_id,
+            'template_id': row.template_id,
+            'recurrence_id': None
+        } for row in rows]
+        if occurrences:
+            result.extend(get_occurrence_values(o) for o in occurrences)
+            result.sort(key=lambda row: (row['date'], row['position']))
         return jsonify(result)
     
     data = request.get_json()
     calendar = Calendar.query.filter_by(id=data['calendar_id'], user_id=view_user.id).first_or_404()
     
     shift_date = datetime.strptime(data['date'], '%Y-%m-%d').date()
-    existing_shifts = Shift.query.filter_by(calendar_id=calendar.id, shift_date=shift_date).count()
-    
-    if existing_shifts >= 2:
-        return jsonify({'error': 'Maximum 2 shifts per day'}), 409
+    start_time = datetime.strptime(data.get('start_time', '09:00'), '%H:%M').time()
+    end_time = datetime.strptime(data.get('end_time', '17:00'), '%H:%M').time()
     
-    shift = Shift(
-        calendar_id=calendar.id,
+    shift = run_in_transaction(lambda: add_shift(
+        calendar.id,
+        shift_date,
         title=data.get('title', 'Shift'),
-        shift_date=shift_date,
-        start_time=datetime.strptime(data.get('start_time', '09:00'), '%H:%M').time(),
-        end_time=datetime.strptime(data.get('end_time', '17:00'), '%H:%M').time(),
+        start_time=start_time,
+        end_time=end_time,
         color=data.get('color', '#3788d8'),
-        position=existing_shifts,
         template_id=data.get('template_id')
-    )
-    db.session.add(shift)
-    db.session.commit()
+    ))
+    if shift is None:
+        return jsonify({'error': 'Maximum 2 shifts per day'}), 409
     return jsonify({'id': shift.id}), 201
 
 
@@ -422,6 +597,9 @@ def api_shifts():
 @require_login
 def api_shift(shift_id):
     view_user = get_view_user()
+    occurrence = find_occurrence(shift_id, Calendar.user_id == view_user.id)
+    if occurrence:
+        return api_occurrence(*occurrence)
     shift = Shift.query.join(Calendar).filter(
         Shift.id == shift_id,
         Calendar.user_id == view_user.id
@@ -443,28 +621,55 @@ def api_shift(shift_id):
     
     if request.method == 'PUT':
         data = request.get_json()
-        shift.title = data.get('title', shift.title)
-        if 'date' in data:
-            shift.shift_date = datetime.strptime(data['date'], '%Y-%m-%d').date()
-        if 'start_time' in data:
-            shift.start_time = datetime.strptime(data['start_time'], '%H:%M').time()
-        if 'end_time' in data:
-            shift.end_time = datetime.strptime(data['end_time'], '%H:%M').time()
-        shift.color = data.get('color', shift.color)
-        db.session.commit()
+        new_date = datetime.strptime(data['date'], '%Y-%m-%d').date() if 'date' in data else None
+        
+        def update():
+            if new_date and not move_shift(shift, new_date):
+                return False
+            shift.title = data.get('title', shift.title)
+            if 'start_time' in data:
+                shift.start_time = datetime.strptime(data['start_time'], '%H:%M').time()
+            if 'end_time' in data:
+                shift.end_time = datetime.strptime(data['end_time'], '%H:%M').time()
+            shift.color = data.get('color', shift.color)
+            return True
+        
+        if not run_in_transaction(update):
+            return jsonify({'error': 'Maximum 2 shifts per day'}), 409
         return jsonify({'success': True})
     
     if request.method == 'DELETE':
-        calendar_id = shift.calendar_id
-        shift_date = shift.shift_date
-        db.session.delete(shift)
-        remaining = Shift.query.filter_by(calendar_id=calendar_id, shift_date=shift_date).order_by(Shift.position).all()
-        for i, s in enumerate(remaining):
-            s.position = i
+        delete_shift(shift)
         db.session.commit()
         return jsonify({'success': True})
 
 
+def api_occurrence(recurrence, day):
+    """GET, PUT or DELETE one occurrence of a recurring shift.
+    
+    DELETE records an exception for the date; PUT replaces the occurrence
+    with a stored shift carrying the changes.
+    """
+    if request.method == 'GET':
+        return jsonify(get_occurrence_values(load_occurrence(recurrence, day)))
+    
+    if request.method == 'PUT':
+        data = request.get_json()
+        new_date = datetime.strptime(data['date'], '%Y-%m-%d').date() if 'date' in data else None
+        fields = {key: data[key] for key in ('title', 'color') if key in data}
+        for key in ('start_time', 'end_time'):
+            if key in data:
+                fields[key] = datetime.strptime(data[key], '%H:%M').time()
+        shift = run_in_transaction(lambda: detach_occurrence(recurrence, day, new_date, **fields))
+        if shift is None:
+            return jsonify({'error': 'Maximum 2 shifts per day'}), 409
+        return jsonify({'success': True, 'id': shift.id})
+    
+    skip_occurrence(recurrence, day)
+    db.session.commit()
+    return jsonify({'success': True})
+
+
 @app.route('/api/shifts/from-template', methods=['POST'])
 @require_login
 def create_shift_from_template():
@@ -474,23 +679,18 @@ def create_shift_from_template():
     calendar = Calendar.query.filter_by(id=data['calendar_id'], user_id=view_user.id).first_or_404()
     
     shift_date = datetime.strptime(data['date'], '%Y-%m-%d').date()
-    existing_shifts = Shift.query.filter_by(calendar_id=calendar.id, shift_date=shift_date).count()
     
-    if existing_shifts >= 2:
-        return jsonify({'error': 'Maximum 2 shifts per day'}), 409
-    
-    shift = Shift(
-        calendar_id=calendar.id,
+    shift = run_in_transaction(lambda: add_shift(
+        calendar.id,
+        shift_date,
         template_id=template.id,
         title=template.name,
-        shift_date=shift_date,
         start_time=template.start_time,
         end_time=template.end_time,
-        color=template.color,
-        position=existing_shifts
-    )
-    db.session.add(shift)
-    db.session.commit()
+        color=template.color
+    ))
+    if shift is None:
+        return jsonify({'error': 'Maximum 2 shifts per day'}), 409
     return jsonify({
         'id': shift.id,
         'title': shift.title,
@@ -504,6 +704,215 @@ def create_shift_from_template():
     }), 201
 
 
+def expand_rotation(pattern):
+    """Yield the working dates of an on/off rotation such as 4 on / 4 off between start and end.
+
+    Dates are produced cycle by cycle without visiting the off days, so a
+    caller can stop after the dates it accepts however long the range is.
+    """
+    start_date = datetime.strptime(pattern['start'], '%Y-%m-%d').date()
+    end_date = datetime.strptime(pattern['end'], '%Y-%m-%d').date()
+    on_days = int(pattern.get('on', 1))
+    off_days = int(pattern.get('off', 0))
+    if on_days < 1 or off_days < 0:
+        raise ValueError('Rotation needs at least one working day')
+    days = (end_date - start_date).days + 1
+    for cycle_start in range(0, days, on_days + off_days):
+        for i in range(cycle_start, min(cycle_start + on_days, days)):
+            yield start_date + timedelta(days=i)
+
+
+@app.route('/api/shifts/bulk', methods=['POST'])
+@require_login
+def create_shifts_bulk():
+    view_user = get_view_user()
+    data = request.get_json()
+    template = ShiftTemplate.query.filter_by(id=data['template_id'], user_id=view_user.id).first_or_404()
+    calendar = Calendar.query.filter_by(id=data['calendar_id'], user_id=view_user.id).first_or_404()
+    
+    try:
+        # One date past the limit is enough to reject the request
+        if 'pattern' in data:
+            dates = list(islice(expand_rotation(data['pattern']), MAX_BULK_SHIFTS + 1))
+        else:
+            dates = [datetime.strptime(d, '%Y-%m-%d').date() for d in islice(data.get('dates', []), MAX_BULK_SHIFTS + 1)]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Invalid dates or rotation pattern'}), 400
+    if not dates:
+        return jsonify({'error': 'No dates given'}), 400
+    if len(dates) > MAX_BULK_SHIFTS:
+        return jsonify({'error': f'At most {MAX_BULK_SHIFTS} shifts per request'}), 400
+    
+    def create():
+        lock_calendar(calendar.id)
+        # One grouped count covers the per-day limit for every requested date
+        counts = dict(db.session.query(Shift.shift_date, func.count(Shift.id)).filter(
+            Shift.calendar_id == calendar.id,
+            Shift.shift_date >= min(dates),
+            Shift.shift_date <= max(dates)
+        ).group_by(Shift.shift_date).all())
+        recurring = Counter()
+        for recurrence in ShiftRecurrence.query.filter(
+            ShiftRecurrence.calendar_id == calendar.id,
+            ShiftRecurrence.dtstart <= max(dates)
+        ):
+            recurring.update(occurrence_dates(recurrence, min(dates), max(dates)))
+        
+        shifts = []
+        skipped = []
+        for shift_date in dates:
+            existing = counts.get(shift_date, 0)
+            if existing + recurring[shift_date] >= MAX_SHIFTS_PER_DAY:
+                skipped.append(shift_date.isoformat())
+                continue
+            counts[shift_date] = existing + 1
+            shifts.append(Shift(
+                calendar_id=calendar.id,
+                template_id=template.id,
+                title=template.name,
+                shift_date=shift_date,
+                start_time=template.start_time,
+                end_time=template.end_time,
+                color=template.color,
+                position=existing
+            ))
+        db.session.add_all(shifts)
+        return shifts, skipped
+    
+    shifts, skipped = run_in_transaction(create)
+    
+    return jsonify({
+        'created': [{
+            'id': shift.id,
+            'title': shift.title,
+            'date': shift.shift_date.isoformat(),
+            'start_time': shift.start_time.strftime('%H:%M'),
+            'end_time': shift.end_time.strftime('%H:%M'),
+            'color': shift.color,
+            'position': shift.position,
+            'calendar_id': shift.calendar_id,
+            'template_id': shift.template_id
+        } for shift in shifts],
+        'skipped': skipped
+    }), 201
+
+
+def recurrence_to_dict(recurrence):
+    return {
+        'id': recurrence.id,
+        'calendar_id': recurrence.calendar_id,
+        'template_id': recurrence.template_id,
+        'rrule': recurrence.rrule,
+        'start': recurrence.dtstart.isoformat(),
+        'exceptions': sorted(e.exception_date.isoformat() for e in recurrence.exceptions)
+    }
+
+
+@app.route('/api/recurrences', methods=['GET', 'POST'])
+@require_login
+def api_recurrences():
+    """Recurring shifts stored as an RRULE on a template instead of one row per date."""
+    view_user = get_view_user()
+    if request.method == 'GET':
+        query = ShiftRecurrence.query.join(Calendar).filter(Calendar.user_id == view_user.id)
+        calendar_id = request.args.get('calendar_id')
+        if calendar_id:
+            query = query.filter(ShiftRecurrence.calendar_id == calendar_id)
+        return jsonify([recurrence_to_dict(r) for r in query.order_by(ShiftRecurrence.dtstart).all()])
+    
+    data = request.get_json()
+    template = ShiftTemplate.query.filter_by(id=data['template_id'], user_id=view_user.id).first_or_404()
+    calendar = Calendar.query.filter_by(id=data['calendar_id'], user_id=view_user.id).first_or_404()
+    
+    try:
+        if 'pattern' in data:
+            rules = rotation_rules(data['pattern'])
+        else:
+            rules = [(datetime.strptime(data['start'], '%Y-%m-%d').date(), data['rrule'])]
+        rules = [(dtstart, normalize_rrule(rule)) for dtstart, rule in rules]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Invalid rrule or rotation pattern'}), 400
+    
+    def create():
+        recurrences = [ShiftRecurrence(calendar_id=calendar.id, template_id=template.id, rrule=rule, dtstart=dtstart)
+                       for dtstart, rule in rules]
+        db.session.add_all(recurrences)
+        return recurrences, skip_full_days(calendar.id, recurrences)
+    
+    recurrences, skipped = run_in_transaction(create)
+    return jsonify({
+        'created': [recurrence_to_dict(r) for r in recurrences],
+        'skipped': [d.isoformat() for d in skipped]
+    }), 201
+
+
+@app.route('/api/recurrences/<recurrence_id>', methods=['GET', 'PUT', 'DELETE'])
+@require_login
+def api_recurrence(recurrence_id):
+    view_user = get_view_user()
+    recurrence = ShiftRecurrence.query.join(Calendar).filter(
+        ShiftRecurrence.id == recurrence_id,
+        Calendar.user_id == view_user.id
+    ).first_or_404()
+    
+    if request.method == 'GET':
+        return jsonify(recurrence_to_dict(recurrence))
+    
+    if request.method == 'PUT':
+        data = request.get_json()
+        try:
+            rrule = normalize_rrule(data['rrule']) if 'rrule' in data else recurrence.rrule
+            dtstart = datetime.strptime(data['start'], '%Y-%m-%d').date() if 'start' in data else recurrence.dtstart
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid rrule or start date'}), 400
+        if 'template_id' in data:
+            ShiftTemplate.query.filter_by(id=data['template_id'], user_id=view_user.id).first_or_404()
+        
+        def update():
+            recurrence.rrule = rrule
+            recurrence.dtstart = dtstart
+            recurrence.template_id = data.get('template_id', recurrence.template_id)
+            return skip_full_days(recurrence.calendar_id, [recurrence])
+        
+        skipped = run_in_transaction(update)
+        return jsonify({'success': True, 'skipped': [d.isoformat() for d in skipped]})
+    
+    db.session.delete(recurrence)
+    db.session.commit()
+    return jsonify({'success': True})
+
+
+@app.route('/api/recurrences/<recurrence_id>/exceptions', methods=['POST'])
+@app.route('/api/recurrences/<recurrence_id>/exceptions/<date_str>', methods=['DELETE'])
+@require_login
+def api_recurrence_exception(recurrence_id, date_str=None):
+    """Skip one date of a recurrence, or restore a skipped date."""
+    view_user = get_view_user()
+    recurrence = ShiftRecurrence.query.join(Calendar).filter(
+        ShiftRecurrence.id == recurrence_id,
+        Calendar.user_id == view_user.id
+    ).first_or_404()
+    try:
+        day = datetime.strptime(date_str or request.get_json()['date'], '%Y-%m-%d').date()
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Invalid date'}), 400
+    
+    if request.method == 'POST':
+        skip_occurrence(recurrence, day)
+        db.session.commit()
+        return jsonify({'success': True}), 201
+    
+    exception = next((e for e in recurrence.exceptions if e.exception_date == day), None)
+    if exception is None:
+        return jsonify({'error': 'Date is not an exception'}), 404
+    lock_calendar(recurrence.calendar_id)
+    if count_day_shifts(recurrence.calendar_id, day) + count_occurrences(recurrence.calendar_id, day) >= MAX_SHIFTS_PER_DAY:
+        return jsonify({'error': 'Maximum 2 shifts per day'}), 409
+    recurrence.exceptions.remove(exception)
+    db.session.commit()
+    return jsonify({'success': True})
+
+
 @app.route('/api/shifts/by-date/<date_str>', methods=['DELETE'])
 @require_login
 def delete_shift_by_date(date_str):
@@ -520,118 +929,453 @@ def delete_shift_by_date(date_str):
         Shift.position == position
     ).first_or_404()
     
-    db.session.delete(shift)
-    remaining = Shift.query.filter_by(calendar_id=calendar_id, shift_date=shift_date).order_by(Shift.position).all()
-    for i, s in enumerate(remaining):
-        s.position = i
+    delete_shift(shift)
     db.session.commit()
     return jsonify({'success': True})
 
 
-@app.route('/ics/<api_key>.ics')
-def ics_feed(api_key):
-    calendar = Calendar.query.filter_by(api_key=api_key).first_or_404()
+def ics_cache_key(entity_id, category):
+    # Merged feeds label events with their calendar, so they are cached apart from the single-calendar bytes
+    return entity_id if category is None else (entity_id, category)
+
+
+def render_ics_event(shift, description, category=None):
+    """Serialize a shift_rows() row as a VEVENT, reusing the cached bytes when its inputs are unchanged."""
+    start_dt = datetime.combine(shift.shift_date, shift.start_time)
+    end_dt = datetime.combine(shift.shift_date, shift.end_time)
+    if end_dt <= start_dt:
+        end_dt += timedelta(days=1)
+    signature = (shift.title, start_dt, end_dt, description)
+    key = ics_cache_key(shift.id, category)
+    cached = event_cache.get(key, signature)
+    if cached is not None:
+        return cached
+    
+    event = ICalEvent()
+    event.add('summary', shift.title)
+    event.add('dtstart', start_dt)
+    event.add('dtend', end_dt)
+    event.add('uid', f'{shift.id}@workshift')
+    if description is not None:
+        event.add('description', description)
+    if category is not None:
+        event.add('categories', [category])
+    data = event.to_ical()
+    event_cache.put(key, signature, data)
+    return data
+
+
+def ics_rrule(rrule, start_time):
+    """An RRULE whose UNTIL matches the event's floating DATE-TIME start.
+
+    Stored rules may end with a DATE (rotations always do), which clients
+    compare against the shift's start time and so drop the last day. The
+    server includes every day whose midnight is not after UNTIL, so UNTIL
+    becomes that last day at the shift's start time.
+    """
+    recur = vRecur.from_ical(rrule)
+    if 'UNTIL' in recur:
+        until = recur['UNTIL'][0]
+        last_day = until.date() if isinstance(until, datetime) else until
+        recur['UNTIL'] = [datetime.combine(last_day, start_time)]
+    return recur
+
+
+def render_recurrence_event(recurrence, category=None):
+    """Serialize a recurrence as one VEVENT with RRULE and EXDATE, cached like single shifts.
+
+    Clients count DTSTART as an occurrence even when the rule doesn't match
+    it (a Thursday start for a Monday rule), so the event starts on the
+    rule's first date instead of the stored start. A rule without any date
+    renders nothing.
+    """
+    template = recurrence.template
+    first = next(iter(build_rule(recurrence.rrule, recurrence.dtstart)), None)
+    if first is None:
+        return b''
+    start_dt = datetime.combine(first.date(), template.start_time)
+    end_dt = datetime.combine(first.date(), template.end_time)
+    if end_dt <= start_dt:
+        end_dt += timedelta(days=1)
+    exdates = sorted(e.exception_date for e in recurrence.exceptions)
+    signature = (template.name, start_dt, end_dt, recurrence.rrule, tuple(exdates))
+    key = ics_cache_key(recurrence.id, category)
+    cached = event_cache.get(key, signature)
+    if cached is not None:
+        return cached
+    
+    event = ICalEvent()
+    event.add('summary', template.name)
+    event.add('dtstart', start_dt)
+    event.add('dtend', end_dt)
+    event.add('rrule', ics_rrule(recurrence.rrule, template.start_time))
+    if exdates:
+        event.add('exdate', [datetime.combine(d, template.start_time) for d in exdates])
+    event.add('uid', f'{recurrence.id}@workshift')
+    if category is not None:
+        event.add('categories', [category])
+    data = event.to_ical()
+    event_cache.put(key, signature, data)
+    return data
+
+
+def parse_feed_window(args):
+    """Resolve the optional ICS date window from start/end or past_days/future_days."""
+    start = args.get('start')
+    end = args.get('end')
+    past_days = args.get('past_days', type=int)
+    future_days = args.get('future_days', type=int)
+    if ('past_days' in args and past_days is None) or ('future_days' in args and future_days is None):
+        raise ValueError('past_days and future_days must be integers')
     
+    start_date = datetime.fromisoformat(start.replace('Z', '')).date() if start else None
+    end_date = datetime.fromisoformat(end.replace('Z', '')).date() if end else None
+    today = date.today()
+    if past_days is not None and start_date is None:
+        start_date = today - timedelta(days=past_days)
+    if future_days is not None and end_date is None:
+        end_date = today + timedelta(days=future_days)
+    return start_date, end_date
+
+
+def generate_ics_feed(calendar_names, feed_name, start_date, end_date, categories=False):
+    """Yield the ICS document piece by piece so large calendars stream in flat memory.
+    
+    calendar_names maps the ids of the calendars to include to their names.
+    With categories each event is labelled with its calendar's name, for
+    merged feeds.
+    """
     cal = ICalendar()
     cal.add('prodid', '-//WorkShift Calendar//EN')
     cal.add('version', '2.0')
     cal.add('calscale', 'GREGORIAN')
     cal.add('method', 'PUBLISH')
-    cal.add('x-wr-calname', calendar.name)
-    
-    shifts = Shift.query.filter_by(calendar_id=calendar.id).all()
-    day_notes = {n.note_date: n.content for n in DayNote.query.filter_by(calendar_id=calendar.id).all()}
+    cal.add('x-wr-calname', feed_name)
+    header, footer = cal.to_ical().rsplit(b'END:VCALENDAR', 1)
+    yield header
     
+    calendar_ids = list(calendar_names)
+    day_notes = {(row.calendar_id, row.note_date): row.content for row in note_rows(
+        DayNote.calendar_id.in_(calendar_ids), *window_criteria(DayNote.note_date, start_date, end_date))}
+    shifts = shift_rows(Shift.calendar_id.in_(calendar_ids), *window_criteria(Shift.shift_date, start_date, end_date),
+                        yield_per=ICS_STREAM_BATCH_SIZE)
     for shift in shifts:
-        display = get_shift_display_values(shift)
-        event = ICalEvent()
-        event.add('summary', display['title'])
-        start_dt = datetime.combine(shift.shift_date, display['start_time'])
-        end_dt = datetime.combine(shift.shift_date, display['end_time'])
-        if end_dt <= start_dt:
-            end_dt += timedelta(days=1)
-        event.add('dtstart', start_dt)
-        event.add('dtend', end_dt)
-        event.add('uid', f'{shift.id}@workshift')
-        if shift.shift_date in day_notes:
-            event.add('description', day_notes[shift.shift_date])
-        cal.add_component(event)
-    
-    response = Response(cal.to_ical(), mimetype='text/calendar')
-    response.headers['Content-Disposition'] = f'attachment; filename="{calendar.name}.ics"'
+        category = calendar_names[shift.calendar_id] if categories else None
+        yield render_ics_event(shift, day_notes.get((shift.calendar_id, shift.shift_date)), category)
+    
+    recurrences = ShiftRecurrence.query.filter(ShiftRecurrence.calendar_id.in_(calendar_ids)).options(joinedload(ShiftRecurrence.template))
+    if end_date:
+        recurrences = recurrences.filter(ShiftRecurrence.dtstart <= end_date)
+    for recurrence in recurrences:
+        # Clients expand the rule themselves; a window only drops rules with no dates in it
+        if (start_date or end_date) and not occurrence_dates(recurrence, start_date, end_date):
+            continue
+        yield render_recurrence_event(recurrence, calendar_names[recurrence.calendar_id] if categories else None)
+    
+    yield b'END:VCALENDAR' + footer
+
+
+def ics_response(etag, last_modified, start_date, end_date, filename, generate):
+    """Answer an ICS feed request with 304 if the client's copy is current, else stream the feed from generate()."""
+    if start_date or end_date:
+        etag += f'-{start_date or ""}-{end_date or ""}'
+    if 'past_days' in request.args or 'future_days' in request.args:
+        # A window relative to today changes at midnight even when the calendar doesn't
+        midnight = datetime.combine(date.today(), datetime.min.time())
+        last_modified = max(last_modified, midnight) if last_modified else midnight
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        response = Response(stream_with_context(generate()), mimetype='text/calendar')
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}.ics"'
+    
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
     return response
 
 
+@app.route('/ics/<api_key>.ics')
+def ics_feed(api_key):
+    calendar = Calendar.query.filter_by(api_key=api_key).first_or_404()
+    try:
+        start_date, end_date = parse_feed_window(request.args)
+    except ValueError:
+        return jsonify({'error': 'Invalid date window'}), 400
+    
+    return ics_response(
+        f'{calendar.id}-{calendar.feed_version or 0}',
+        calendar.feed_updated_at or calendar.updated_at,
+        start_date, end_date, calendar.name,
+        lambda: generate_ics_feed({calendar.id: calendar.name}, calendar.name, start_date, end_date)
+    )
+
+
+def get_user_by_feed_token(feed_token):
+    return User.query.filter_by(feed_token=feed_token).first_or_404()
+
+
+def merged_feed_calendars(user_id, args):
+    """The user's calendars for a merged feed: all of them, or those listed in ?calendars=id,id."""
+    query = Calendar.query.filter_by(user_id=user_id)
+    selected = args.get('calendars')
+    if selected:
+        query = query.filter(Calendar.id.in_(selected.split(',')))
+    return query.order_by(Calendar.name).all()
+
+
+def merged_feed_etag(user_id, calendars):
+    """Validator that changes whenever any merged calendar changes or the set of calendars does."""
+    versions = ','.join(f'{c.id}:{c.feed_version or 0}' for c in sorted(calendars, key=lambda c: c.id))
+    return f'{user_id}-{hashlib.sha1(versions.encode()).hexdigest()[:16]}'
+
+
+@app.route('/ics/user/<feed_token>.ics')
+def merged_ics_feed(feed_token):
+    user = get_user_by_feed_token(feed_token)
+    calendars = merged_feed_calendars(user.id, request.args)
+    try:
+        start_date, end_date = parse_feed_window(request.args)
+    except ValueError:
+        return jsonify({'error': 'Invalid date window'}), 400
+    
+    calendar_names = {c.id: c.name for c in calendars}
+    feed_name = f'{user.username} (all calendars)'
+    return ics_response(
+        merged_feed_etag(user.id, calendars),
+        max((c.feed_updated_at or c.updated_at for c in calendars), default=user.updated_at),
+        start_date, end_date, feed_name,
+        lambda: generate_ics_feed(calendar_names, feed_name, start_date, end_date, categories=True)
+    )
+
+
+def add_external_shift(calendar_id, data):
+    """Add a shift, and its day note if a description is given, from an external API or webhook payload."""
+    shift_date = datetime.strptime(data['date'], '%Y-%m-%d').date() if 'date' in data else datetime.fromisoformat(data['start'].replace('Z', '')).date()
+    shift = add_shift(
+        calendar_id,
+        shift_date,
+        title=data.get('summary', data.get('title', 'Shift')),
+        start_time=datetime.strptime(data.get('start_time', '09:00'), '%H:%M').time(),
+        end_time=datetime.strptime(data.get('end_time', '17:00'), '%H:%M').time()
+    )
+    if shift is not None and data.get('description'):
+        set_day_note(calendar_id, shift_date, data['description'])
+    return shift
+
+
+def update_external_shift(shift, data):
+    """Apply an external API update payload to a shift. Returns False if the new day is full."""
+    if 'date' in data and not move_shift(shift, datetime.strptime(data['date'], '%Y-%m-%d').date()):
+        return False
+    shift.title = data.get('summary', data.get('title', shift.title))
+    if 'start_time' in data:
+        shift.start_time = datetime.strptime(data['start_time'], '%H:%M').time()
+    if 'end_time' in data:
+        shift.end_time = datetime.strptime(data['end_time'], '%H:%M').time()
+    if 'description' in data:
+        set_day_note(shift.calendar_id, shift.shift_date, data['description'])
+    return True
+
+
+def external_shift_event(row, day_notes):
+    """External API event for a shift_rows() row."""
+    return {
+        'id': row.id,
+        'summary': row.title,
+        'date': row.shift_date.isoformat(),
+        'start_time': row.start_time.strftime('%H:%M'),
+        'end_time': row.end_time.strftime('%H:%M'),
+        'description': day_notes.get(row.shift_date),
+        'position': row.position
+    }
+
+
+def external_occurrence_event(occurrence, day_notes):
+    template = occurrence.recurrence.template
+    return {
+        'id': occurrence.id,
+        'summary': template.name,
+        'date': occurrence.date.isoformat(),
+        'start_time': template.start_time.strftime('%H:%M'),
+        'end_time': template.end_time.strftime('%H:%M'),
+        'description': day_notes.get(occurrence.date),
+        'position': occurrence.position,
+        'recurrence_id': occurrence.recurrence.id
+    }
+
+
+def external_api_changes(calendar, sync_token, start_date, end_date):
+    """Delta response for external_api_events: what changed since the client's sync token."""
+    prune_tombstones(calendar.id)
+    try:
+        version = parse_sync_token(sync_token, calendar.id)
+    except ValueError:
+        return jsonify({'error': 'Invalid sync_token'}), 400
+    except SyncTokenExpired:
+        return jsonify({'error': 'sync_token expired, fetch without sync_token'}), 410
+    
+    feed_version, _ = current_sync_state(calendar.id)
+    changes = changes_since(calendar.id, version, start_date, end_date)
+    events = [external_shift_event(s, changes.day_notes) for s in changes.shifts]
+    events.extend(external_occurrence_event(o, changes.day_notes) for o in changes.occurrences)
+    events.sort(key=lambda e: (e['date'], e['position']))
+    return jsonify({
+        'calendar': {'id': calendar.id, 'name': calendar.name},
+        'sync_token': str(feed_version),
+        'events': events,
+        'notes': [{
+            'id': n.id,
+            'date': n.note_date.isoformat(),
+            'content': n.content,
+            'position': n.position
+        } for n in changes.notes],
+        'deleted': changes.deleted
+    })
+
+
 @app.route('/api/v1/calendar/<api_key>/events', methods=['GET', 'POST'])
 def external_api_events(api_key):
-    calendar = Calendar.query.filter_by(api_key=api_key).first_or_404()
+    calendar = get_calendar_by_api_key(api_key)
     
     if request.method == 'GET':
         start = request.args.get('start')
         end = request.args.get('end')
+        start_date = datetime.fromisoformat(start.replace('Z', '')).date() if start else None
+        end_date = datetime.fromisoformat(end.replace('Z', '')).date() if end else None
         
-        query = Shift.query.filter_by(calendar_id=calendar.id)
-        if start:
-            start_date = datetime.fromisoformat(start.replace('Z', '')).date()
-            query = query.filter(Shift.shift_date >= start_date)
-        if end:
-            end_date = datetime.fromisoformat(end.replace('Z', '')).date()
-            query = query.filter(Shift.shift_date <= end_date)
+        sync_token = request.args.get('sync_token')
+        if sync_token is not None:
+            return external_api_changes(calendar, sync_token, start_date, end_date)
         
-        shifts = query.order_by(Shift.shift_date, Shift.position).all()
-        day_notes = {n.note_date: n.content for n in DayNote.query.filter_by(calendar_id=calendar.id).all()}
+        # Read the token before the rows so changes made meanwhile are sent again next time
+        feed_version, _ = current_sync_state(calendar.id)
+        rows = shift_rows(Shift.calendar_id == calendar.id, *window_criteria(Shift.shift_date, start_date, end_date))
+        recurrences = ShiftRecurrence.query.filter(
+            ShiftRecurrence.calendar_id == calendar.id,
+            *window_criteria(ShiftRecurrence.dtstart, None, end_date)
+        ).options(joinedload(ShiftRecurrence.template)).all()
+        occurrences = expand_recurrences(recurrences, start_date, end_date, rows) if recurrences else []
+        # Only the notes inside the window can describe an event
+        day_notes = {row.note_date: row.content for row in note_rows(
+            DayNote.calendar_id == calendar.id, *window_criteria(DayNote.note_date, start_date, end_date))}
         
-        events = []
-        for s in shifts:
-            display = get_shift_display_values(s)
-            events.append({
-                'id': s.id,
-                'summary': display['title'],
-                'date': s.shift_date.isoformat(),
-                'start_time': display['start_time'].strftime('%H:%M'),
-                'end_time': display['end_time'].strftime('%H:%M'),
-                'description': day_notes.get(s.shift_date),
-                'position': s.position
-            })
+        if wants_compact(request.args):
+            payload = encode_events(rows, occurrences, day_notes)
+            payload.update({'calendar': {'id': calendar.id, 'name': calendar.name}, 'sync_token': str(feed_version)})
+            return jsonify(payload)
+        
+        events = [external_shift_event(row, day_notes) for row in rows]
+        if occurrences:
+            events.extend(external_occurrence_event(o, day_notes) for o in occurrences)
+            events.sort(key=lambda e: (e['date'], e['position']))
         
         return jsonify({
             'calendar': {'id': calendar.id, 'name': calendar.name},
+            'sync_token': str(feed_version),
             'events': events
         })
     
     data = request.get_json()
-    shift_date = datetime.strptime(data['date'], '%Y-%m-%d').date() if 'date' in data else datetime.fromisoformat(data['start'].replace('Z', '')).date()
-    existing = Shift.query.filter_by(calendar_id=calendar.id, shift_date=shift_date).count()
-    
-    if existing >= 2:
+    shift = run_in_transaction(lambda: add_external_shift(calendar.id, data))
+    if shift is None:
         return jsonify({'error': 'Maximum 2 shifts per day'}), 409
+    return jsonify({'id': shift.id, 'status': 'created'}), 201
+
+
+@app.route('/api/v1/user/<feed_token>/events')
+def merged_api_events(feed_token):
+    """Events of several calendars of a user, read with one query per table instead of one request per calendar."""
+    user = get_user_by_feed_token(feed_token)
+    calendars = merged_feed_calendars(user.id, request.args)
+    try:
+        start_date, end_date = parse_feed_window(request.args)
+    except ValueError:
+        return jsonify({'error': 'Invalid date window'}), 400
     
-    shift = Shift(
-        calendar_id=calendar.id,
-        title=data.get('summary', data.get('title', 'Shift')),
-        shift_date=shift_date,
-        start_time=datetime.strptime(data.get('start_time', '09:00'), '%H:%M').time(),
-        end_time=datetime.strptime(data.get('end_time', '17:00'), '%H:%M').time(),
-        position=existing
-    )
-    db.session.add(shift)
-    db.session.commit()
+    calendar_ids = [c.id for c in calendars]
+    rows = shift_rows(Shift.calendar_id.in_(calendar_ids), *window_criteria(Shift.shift_date, start_date, end_date))
+    recurrences = ShiftRecurrence.query.filter(
+        ShiftRecurrence.calendar_id.in_(calendar_ids),
+        *window_criteria(ShiftRecurrence.dtstart, None, end_date)
+    ).options(joinedload(ShiftRecurrence.template)).all()
+    occurrences = expand_recurrences(recurrences, start_date, end_date, rows) if recurrences else []
+    day_notes = {calendar_id: {} for calendar_id in calendar_ids}
+    for row in note_rows(DayNote.calendar_id.in_(calendar_ids), *window_criteria(DayNote.note_date, start_date, end_date)):
+        day_notes[row.calendar_id][row.note_date] = row.content
+    
+    labels = {c.id: {'calendar_id': c.id, 'categories': [c.name], 'color': c.color} for c in calendars}
+    events = []
+    for row in rows:
+        event = external_shift_event(row, day_notes[row.calendar_id])
+        event.update(labels[row.calendar_id])
+        events.append(event)
+    for occurrence in occurrences:
+        calendar_id = occurrence.recurrence.calendar_id
+        event = external_occurrence_event(occurrence, day_notes[calendar_id])
+        event.update(labels[calendar_id])
+        events.append(event)
+    events.sort(key=lambda e: (e['date'], e['categories'][0], e['calendar_id'], e['position']))
+    
+    return jsonify({
+        'calendars': [{'id': c.id, 'name': c.name, 'color': c.color} for c in calendars],
+        'events': events
+    })
+
+
+def open_change_stream(calendar_id):
+    """Server-sent event stream of a calendar's changes for the calling client.
     
-    if data.get('description'):
-        note = DayNote.query.filter_by(calendar_id=calendar.id, note_date=shift_date).first()
-        if note:
-            note.content = data['description']
+    A reconnecting EventSource sends the last sync_token it received as
+    Last-Event-ID and first gets one change event covering what it missed,
+    or a reset event if the token is too old to summarize.
+    """
+    feed_version, _ = current_sync_state(calendar_id)
+    subscription = change_hub.subscribe(calendar_id, feed_version)
+    if subscription is None:
+        response = jsonify({'error': 'Too many open change streams, poll instead'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+    messages, version = subscription
+    first = format_event('ready', {'calendar_id': calendar_id, 'sync_token': str(version)}, event_id=version)
+    last_token = request.headers.get('Last-Event-ID') or request.args.get('sync_token')
+    if last_token is not None:
+        try:
+            since = parse_sync_token(last_token, calendar_id)
+        except (ValueError, SyncTokenExpired):
+            first = format_event('reset', {'calendar_id': calendar_id, 'sync_token': str(version)}, event_id=version)
         else:
-            note = DayNote(calendar_id=calendar.id, note_date=shift_date, content=data['description'])
-            db.session.add(note)
-        db.session.commit()
+            if since < version:
+                first = change_event(calendar_id, version, since)
     
-    return jsonify({'id': shift.id, 'status': 'created'}), 201
+    response = Response(stream_messages(calendar_id, messages, first), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keep proxies (e.g. the HA ingress nginx) from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/api/calendars/<calendar_id>/stream')
+@require_login
+def api_calendar_stream(calendar_id):
+    view_user = get_view_user()
+    calendar = Calendar.query.filter_by(id=calendar_id, user_id=view_user.id).first_or_404()
+    return open_change_stream(calendar.id)
+
+
+@app.route('/api/v1/calendar/<api_key>/stream')
+def external_api_stream(api_key):
+    calendar = get_calendar_by_api_key(api_key)
+    return open_change_stream(calendar.id)
 
 
 @app.route('/api/v1/calendar/<api_key>/events/<event_id>', methods=['GET', 'PUT', 'DELETE'])
 def external_api_event(api_key, event_id):
-    calendar = Calendar.query.filter_by(api_key=api_key).first_or_404()
+    calendar = get_calendar_by_api_key(api_key)
+    occurrence = find_occurrence(event_id, Calendar.id == calendar.id)
+    if occurrence:
+        return external_api_occurrence(*occurrence)
     shift = Shift.query.filter_by(id=event_id, calendar_id=calendar.id).first_or_404()
     
     if request.method == 'GET':
@@ -648,83 +1392,147 @@ def external_api_event(api_key, event_id):
     
     if request.method == 'PUT':
         data = request.get_json()
-        shift.title = data.get('summary', data.get('title', shift.title))
-        if 'date' in data:
-            shift.shift_date = datetime.strptime(data['date'], '%Y-%m-%d').date()
-        if 'start_time' in data:
-            shift.start_time = datetime.strptime(data['start_time'], '%H:%M').time()
-        if 'end_time' in data:
-            shift.end_time = datetime.strptime(data['end_time'], '%H:%M').time()
-        db.session.commit()
-        
-        if 'description' in data:
-            day_note = DayNote.query.filter_by(calendar_id=calendar.id, note_date=shift.shift_date).first()
-            if day_note:
-                day_note.content = data['description']
-            else:
-                day_note = DayNote(calendar_id=calendar.id, note_date=shift.shift_date, content=data['description'])
-                db.session.add(day_note)
-            db.session.commit()
-        
+        if not run_in_transaction(lambda: update_external_shift(shift, data)):
+            return jsonify({'error': 'Maximum 2 shifts per day'}), 409
         return jsonify({'status': 'updated'})
     
     if request.method == 'DELETE':
-        calendar_id = shift.calendar_id
-        shift_date = shift.shift_date
-        db.session.delete(shift)
-        remaining = Shift.query.filter_by(calendar_id=calendar_id, shift_date=shift_date).order_by(Shift.position).all()
-        for i, s in enumerate(remaining):
-            s.position = i
+        delete_shift(shift)
         db.session.commit()
         return jsonify({'status': 'deleted'})
 
 
+def external_occurrence_fields(data):
+    """Shift fields an external API or webhook payload overrides on a detached occurrence."""
+    fields = {}
+    if 'summary' in data or 'title' in data:
+        fields['title'] = data.get('summary', data.get('title'))
+    for key in ('start_time', 'end_time'):
+        if key in data:
+            fields[key] = datetime.strptime(data[key], '%H:%M').time()
+    return fields
+
+
+def update_external_occurrence(recurrence, day, data):
+    """Detach an occurrence for an external update payload. Returns the new shift, or None if the day is full."""
+    new_date = datetime.strptime(data['date'], '%Y-%m-%d').date() if 'date' in data else None
+    shift = detach_occurrence(recurrence, day, new_date, **external_occurrence_fields(data))
+    if shift is not None and 'description' in data:
+        set_day_note(shift.calendar_id, shift.shift_date, data['description'])
+    return shift
+
+
+def external_api_occurrence(recurrence, day):
+    """GET, PUT or DELETE one occurrence of a recurring shift through the external API."""
+    if request.method == 'GET':
+        occurrence = load_occurrence(recurrence, day)
+        template = recurrence.template
+        day_note = DayNote.query.filter_by(calendar_id=recurrence.calendar_id, note_date=day).first()
+        return jsonify({
+            'id': occurrence.id,
+            'summary': template.name,
+            'date': day.isoformat(),
+            'start_time': template.start_time.strftime('%H:%M'),
+            'end_time': template.end_time.strftime('%H:%M'),
+            'description': day_note.content if day_note else None,
+            'position': occurrence.position,
+            'recurrence_id': recurrence.id
+        })
+    
+    if request.method == 'PUT':
+        data = request.get_json()
+        shift = run_in_transaction(lambda: update_external_occurrence(recurrence, day, data))
+        if shift is None:
+            return jsonify({'error': 'Maximum 2 shifts per day'}), 409
+        return jsonify({'status': 'updated', 'id': shift.id})
+    
+    skip_occurrence(recurrence, day)
+    db.session.commit()
+    return jsonify({'status': 'deleted'})
+
+
+def validate_webhook_action(item):
+    """Return an error message for a malformed webhook action, or None if it can be applied."""
+    if not isinstance(item, dict):
+        return 'Action must be an object'
+    action = item.get('action', 'create')
+    if action not in ('create', 'update', 'delete'):
+        return f'Unknown action: {action}'
+    if action in ('update', 'delete') and not (isinstance(item.get('event_id'), str) and item['event_id']):
+        return 'event_id must be a non-empty string'
+    if action == 'create' and 'date' not in item and 'start' not in item:
+        return 'date or start is required'
+    try:
+        if 'date' in item:
+            datetime.strptime(item['date'], '%Y-%m-%d')
+        elif 'start' in item:
+            datetime.fromisoformat(item['start'].replace('Z', ''))
+        for field in ('start_time', 'end_time'):
+            if field in item:
+                datetime.strptime(item[field], '%H:%M')
+    except (TypeError, ValueError, AttributeError):
+        return 'Invalid date or time'
+    return None
+
+
+def apply_webhook_action(calendar_id, item):
+    """Apply one validated webhook action in the current transaction and describe the outcome."""
+    action = item.get('action', 'create')
+    if action == 'create':
+        shift = add_external_shift(calendar_id, item)
+        if shift is None:
+            return {'status': 'day_full', 'error': 'Maximum 2 shifts per day'}
+        db.session.flush()
+        return {'status': 'created', 'id': shift.id}
+    
+    occurrence = find_occurrence(item['event_id'], Calendar.id == calendar_id)
+    if occurrence:
+        if action == 'delete':
+            skip_occurrence(*occurrence)
+            return {'status': 'deleted', 'id': item['event_id']}
+        shift = update_external_occurrence(*occurrence, item)
+        if shift is None:
+            return {'status': 'day_full', 'id': item['event_id'], 'error': 'Maximum 2 shifts per day'}
+        db.session.flush()
+        return {'status': 'updated', 'id': shift.id}
+    
+    shift = Shift.query.filter_by(id=item['event_id'], calendar_id=calendar_id).first()
+    if not shift:
+        return {'status': 'not_found', 'id': item['event_id']}
+    if action == 'delete':
+        delete_shift(shift)
+        return {'status': 'deleted', 'id': item['event_id']}
+    if not update_external_shift(shift, item):
+        return {'status': 'day_full', 'id': shift.id, 'error': 'Maximum 2 shifts per day'}
+    return {'status': 'updated', 'id': shift.id}
+
+
 @app.route('/webhook/<api_key>', methods=['POST'])
 def webhook_receiver(api_key):
-    calendar = Calendar.query.filter_by(api_key=api_key).first_or_404()
+    calendar = get_calendar_by_api_key(api_key)
     data = request.get_json()
     
+    if isinstance(data, list) or 'actions' in data:
+        return webhook_batch(calendar, data if isinstance(data, list) else data['actions'])
+    
     action = data.get('action', 'create')
     
     if action == 'create':
-        shift_date = datetime.strptime(data['date'], '%Y-%m-%d').date() if 'date' in data else datetime.fromisoformat(data['start'].replace('Z', '')).date()
-        existing = Shift.query.filter_by(calendar_id=calendar.id, shift_date=shift_date).count()
-        
-        if existing >= 2:
+        shift = run_in_transaction(lambda: add_external_shift(calendar.id, data))
+        if shift is None:
             return jsonify({'error': 'Maximum 2 shifts per day'}), 409
-        
-        shift = Shift(
-            calendar_id=calendar.id,
-            title=data.get('summary', data.get('title', 'Shift')),
-            shift_date=shift_date,
-            start_time=datetime.strptime(data.get('start_time', '09:00'), '%H:%M').time(),
-            end_time=datetime.strptime(data.get('end_time', '17:00'), '%H:%M').time(),
-            position=existing
-        )
-        db.session.add(shift)
-        db.session.commit()
-        
-        if data.get('description'):
-            note = DayNote.query.filter_by(calendar_id=calendar.id, note_date=shift_date).first()
-            if note:
-                note.content = data['description']
-            else:
-                note = DayNote(calendar_id=calendar.id, note_date=shift_date, content=data['description'])
-                db.session.add(note)
-            db.session.commit()
-        
         return jsonify({'status': 'created', 'id': shift.id}), 201
     
     elif action == 'delete':
         event_id = data.get('event_id')
+        occurrence = find_occurrence(event_id or '', Calendar.id == calendar.id)
+        if occurrence:
+            skip_occurrence(*occurrence)
+            db.session.commit()
+            return jsonify({'status': 'deleted'})
         shift = Shift.query.filter_by(id=event_id, calendar_id=calendar.id).first()
         if shift:
-            calendar_id = shift.calendar_id
-            shift_date = shift.shift_date
-            db.session.delete(shift)
-            remaining = Shift.query.filter_by(calendar_id=calendar_id, shift_date=shift_date).order_by(Shift.position).all()
-            for i, s in enumerate(remaining):
-                s.position = i
+            delete_shift(shift)
             db.session.commit()
             return jsonify({'status': 'deleted'})
         return jsonify({'status': 'not_found'}), 404
@@ -732,6 +1540,25 @@ def webhook_receiver(api_key):
     return jsonify({'status': 'unknown_action'}), 400
 
 
+def webhook_batch(calendar, actions):
+    """Validate a list of webhook actions up front, then apply them all in one transaction."""
+    if not isinstance(actions, list) or not actions:
+        return jsonify({'error': 'actions must be a non-empty list'}), 400
+    if len(actions) > MAX_WEBHOOK_ACTIONS:
+        return jsonify({'error': f'At most {MAX_WEBHOOK_ACTIONS} actions per request'}), 400
+    
+    errors = [{'index': i, 'error': error}
+              for i, error in enumerate(validate_webhook_action(item) for item in actions) if error]
+    if errors:
+        return jsonify({'status': 'invalid', 'errors': errors}), 400
+    
+    calendar_id = calendar.id
+    results = run_in_transaction(lambda: [
+        dict(apply_webhook_action(calendar_id, item), index=i) for i, item in enumerate(actions)
+    ])
+    return jsonify({'status': 'ok', 'results': results})
+
+
 @app.route('/api/day-notes', methods=['GET', 'POST'])
 @require_login
 def api_day_notes():
@@ -741,24 +1568,25 @@ def api_day_notes():
         start = request.args.get('start')
         end = request.args.get('end')
         
-        query = DayNote.query.join(Calendar).filter(Calendar.user_id == view_user.id)
+        criteria = [DayNote.calendar_id.in_(user_calendar_ids(view_user.id))]
+        start_date = end_date = None
         if calendar_id:
-            query = query.filter(DayNote.calendar_id == calendar_id)
+            criteria.append(DayNote.calendar_id == calendar_id)
         if start:
             start_date = datetime.fromisoformat(start.replace('Z', '')).date()
-            query = query.filter(DayNote.note_date >= start_date)
         if end:
             end_date = datetime.fromisoformat(end.replace('Z', '')).date()
-            query = query.filter(DayNote.note_date <= end_date)
         
-        notes = query.order_by(DayNote.note_date).all()
+        rows = note_rows(*criteria, *window_criteria(DayNote.note_date, start_date, end_date))
+        if wants_compact(request.args):
+            return jsonify(encode_notes(rows))
         return jsonify([{
-            'id': n.id,
-            'date': n.note_date.isoformat(),
-            'content': n.content,
-            'calendar_id': n.calendar_id,
-            'position': n.position or 'top'
-        } for n in notes])
+            'id': row.id,
+            'date': row.note_date.isoformat(),
+            'content': row.content,
+            'calendar_id': row.calendar_id,
+            'position': row.position or 'top'
+        } for row in rows])
     
     data = request.get_json()
     calendar = Calendar.query.filter_by(id=data['calendar_id'], user_id=view_user.id).first_or_404()
@@ -813,6 +1641,84 @@ def api_day_note(note_id):
         return jsonify({'success': True})
 
 
+@app.route('/api/calendar-view', methods=['GET'])
+@require_login
+def api_calendar_view():
+    """Shifts, day notes and template metadata for a date window in one response.
+    
+    Templated shifts only carry their template_id; the client resolves title,
+    times and color from the templates map.
+    """
+    view_user = get_view_user()
+    calendar_id = request.args.get('calendar_id')
+    start = request.args.get('start')
+    end = request.args.get('end')
+    
+    shift_criteria = [Shift.calendar_id.in_(user_calendar_ids(view_user.id))]
+    note_criteria = [DayNote.calendar_id.in_(user_calendar_ids(view_user.id))]
+    recurrence_query = ShiftRecurrence.query.join(Calendar).filter(Calendar.user_id == view_user.id)
+    start_date = end_date = None
+    if calendar_id:
+        shift_criteria.append(Shift.calendar_id == calendar_id)
+        note_criteria.append(DayNote.calendar_id == calendar_id)
+        recurrence_query = recurrence_query.filter(ShiftRecurrence.calendar_id == calendar_id)
+    if start:
+        start_date = datetime.fromisoformat(start.replace('Z', '')).date()
+    if end:
+        end_date = datetime.fromisoformat(end.replace('Z', '')).date()
+        recurrence_query = recurrence_query.filter(ShiftRecurrence.dtstart <= end_date)
+    
+    shifts = shift_rows(*shift_criteria, *window_criteria(Shift.shift_date, start_date, end_date))
+    templates = {t.id: t for t in ShiftTemplate.query.filter_by(user_id=view_user.id).all()}
+    missing = {s.template_id for s in shifts if s.template_id and s.template_id not in templates}
+    if missing:
+        templates.update({t.id: t for t in ShiftTemplate.query.filter(ShiftTemplate.id.in_(missing))})
+    occurrences = expand_recurrences(recurrence_query.all(), start_date, end_date, shifts)
+    
+    shift_entries = []
+    for s in shifts:
+        row = {'id': s.id, 'date': s.shift_date.isoformat(), 'position': s.position}
+        if s.template_id:
+            row['template_id'] = s.template_id
+        else:
+            row.update({
+                'title': s.title,
+                'start_time': s.start_time.strftime('%H:%M'),
+                'end_time': s.end_time.strftime('%H:%M'),
+                'color': s.color
+            })
+        if not calendar_id:
+            row['calendar_id'] = s.calendar_id
+        shift_entries.append(row)
+    for o in occurrences:
+        row = {'id': o.id, 'date': o.date.isoformat(), 'position': o.position,
+               'template_id': o.recurrence.template_id, 'recurrence_id': o.recurrence.id}
+        if not calendar_id:
+            row['calendar_id'] = o.recurrence.calendar_id
+        shift_entries.append(row)
+    if occurrences:
+        shift_entries.sort(key=lambda row: (row['date'], row['position']))
+    
+    note_entries = []
+    for n in note_rows(*note_criteria, *window_criteria(DayNote.note_date, start_date, end_date)):
+        row = {'id': n.id, 'date': n.note_date.isoformat(), 'content': n.content, 'position': n.position or 'top'}
+        if not calendar_id:
+            row['calendar_id'] = n.calendar_id
+        note_entries.append(row)
+    
+    return jsonify({
+        'calendar_id': calendar_id,
+        'templates': {t.id: {
+            'name': t.name,
+            'start_time': t.start_time.strftime('%H:%M'),
+            'end_time': t.end_time.strftime('%H:%M'),
+            'color': t.color
+        } for t in templates.values()},
+        'shifts': shift_entries,
+        'notes': note_entries
+    })
+
+
 @app.errorhandler(403)
 def forbidden(e):
     return render_template('403.html'), 403
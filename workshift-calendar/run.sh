@@ -8,6 +8,23 @@ export LOG_LEVEL=$(bashio::config 'log_level')
 export ADMIN_MODE=$(bashio::config 'admin_mode')
 export INGRESS_MODE=true
 export EXTERNAL_URL=$(bashio::config 'external_url')
+export METRICS_ENABLED=$(bashio::config 'metrics')
+export METRICS_TOKEN=$(bashio::config 'metrics_token')
+export METRICS_DIR=/tmp/workshift-metrics
+export CACHE_DIR=/tmp/workshift-cache
+
+WORKERS=$(bashio::config 'workers')
+WORKER_CLASS=$(bashio::config 'worker_class')
+WEB_THREADS=$(bashio::config 'threads')
+if [ "${WORKER_CLASS}" = "sync" ]; then
+    # gunicorn silently switches sync workers to gthread when threads > 1
+    WEB_THREADS=1
+fi
+export WEB_THREADS
+
+if bashio::config.has_value 'max_streams'; then
+    export PUSH_MAX_STREAMS=$(bashio::config 'max_streams')
+fi
 
 SESSION_SECRET=$(bashio::config 'session_secret')
 if [ -z "$SESSION_SECRET" ]; then
@@ -26,21 +43,30 @@ else
     bashio::log.info "No external database service detected, using SQLite"
     mkdir -p /data/db
     export DATABASE_URL="sqlite:////data/db/workshift.db"
+    export SQLITE_PERFORMANCE=$(bashio::config 'sqlite_performance')
+    bashio::log.info "SQLite performance mode: ${SQLITE_PERFORMANCE}"
 fi
 
 bashio::log.info "Database URL configured"
 bashio::log.info "Log level: ${LOG_LEVEL}"
 bashio::log.info "Admin mode: ${ADMIN_MODE}"
+bashio::log.info "Metrics: ${METRICS_ENABLED}"
+bashio::log.info "Web server: ${WORKERS} ${WORKER_CLASS} worker(s), ${WEB_THREADS} thread(s) each"
 
 cd /app
 
-bashio::log.info "Initializing database..."
-python3 -c "from app import app, db; app.app_context().push(); db.create_all()"
+bashio::log.info "Migrating database..."
+python3 -c "from app import app; from migrations import migrate; app.app_context().push(); migrate()"
+
+# Per-worker metric snapshots from a previous run would be counted again
+rm -rf "${METRICS_DIR}"
 
 bashio::log.info "Starting web server on port 8099..."
 exec python3 -m gunicorn \
     --bind 0.0.0.0:8099 \
-    --workers 2 \
+    --workers "${WORKERS}" \
+    --worker-class "${WORKER_CLASS}" \
+    --threads "${WEB_THREADS}" \
     --access-logfile - \
     --error-logfile - \
     --log-level "${LOG_LEVEL}" \
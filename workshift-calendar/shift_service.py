@@ -0,0 +1,212 @@
+from collections import Counter
+from datetime import date, timedelta
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import Calendar, Shift, DayNote, ShiftRecurrence, ShiftRecurrenceException
+from recurrence import MAX_SHIFTS_PER_DAY, RECURRENCE_HORIZON_DAYS, count_occurrences, occurrence_dates
+
+CONFLICT_RETRIES = 3
+
+
+def run_in_transaction(operation):
+    """Run operation() and commit, starting over if a concurrent request won a unique constraint.
+
+    The unique (calendar_id, shift_date, position) index turns a lost race
+    for a day's slot into an IntegrityError; retrying re-reads the day and
+    either takes the next position or reports the day as full. The
+    operation must do all of its reads and writes inside the call.
+    """
+    for attempt in range(CONFLICT_RETRIES):
+        try:
+            result = operation()
+            db.session.commit()
+            return result
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == CONFLICT_RETRIES - 1:
+                raise
+
+
+def lock_calendar(calendar_id):
+    """Hold a calendar's row lock until commit, so checks of its daily limit run one at a time.
+
+    The unique position index stops two stored shifts from taking the same
+    slot, but not a shift and a recurring shift both counting a day as
+    free. Every check of the limit takes this lock before it counts; a
+    concurrent writer waits for the commit and then counts the committed
+    rows. The no-op UPDATE locks the row on server databases and takes
+    the write lock on SQLite.
+    """
+    calendars = Calendar.__table__
+    db.session.execute(calendars.update().where(calendars.c.id == calendar_id)
+                       .values(feed_version=calendars.c.feed_version))
+
+
+def count_day_shifts(calendar_id, shift_date):
+    return Shift.query.filter_by(calendar_id=calendar_id, shift_date=shift_date).count()
+
+
+def add_shift(calendar_id, shift_date, **fields):
+    """Add a shift at the next position of its day, or return None if the day is full.
+    
+    Recurring shifts on the day count toward the limit; stored shifts take
+    the positions before them.
+    """
+    lock_calendar(calendar_id)
+    position = count_day_shifts(calendar_id, shift_date)
+    if position + count_occurrences(calendar_id, shift_date) >= MAX_SHIFTS_PER_DAY:
+        return None
+    shift = Shift(calendar_id=calendar_id, shift_date=shift_date, position=position, **fields)
+    db.session.add(shift)
+    return shift
+
+
+def compact_positions(calendar_id, shift_date, position):
+    """Close the gap left at position on a day with a single UPDATE.
+    
+    The renumbered shifts are stamped with the calendar's current feed
+    version so delta sync clients pick up their new positions.
+    """
+    db.session.execute(
+        db.update(Shift)
+        .where(
+            Shift.calendar_id == calendar_id,
+            Shift.shift_date == shift_date,
+            Shift.position > position
+        )
+        .values(
+            position=Shift.position - 1,
+            sync_version=db.select(Calendar.feed_version).where(Calendar.id == Shift.calendar_id).scalar_subquery()
+        )
+    )
+
+
+def delete_shift(shift):
+    """Delete a shift and close the gap it leaves in its day's positions.
+
+    Runs in the caller's transaction; the remaining shifts of the day are
+    renumbered with a single UPDATE instead of being loaded one by one.
+    """
+    calendar_id = shift.calendar_id
+    shift_date = shift.shift_date
+    position = shift.position or 0
+    db.session.delete(shift)
+    db.session.flush()
+    compact_positions(calendar_id, shift_date, position)
+
+
+def move_shift(shift, shift_date):
+    """Move a shift to another day, taking that day's next position. Returns False if the day is full."""
+    if shift.shift_date == shift_date:
+        return True
+    lock_calendar(shift.calendar_id)
+    position = count_day_shifts(shift.calendar_id, shift_date)
+    if position + count_occurrences(shift.calendar_id, shift_date) >= MAX_SHIFTS_PER_DAY:
+        return False
+    old_date = shift.shift_date
+    old_position = shift.position or 0
+    shift.shift_date = shift_date
+    shift.position = position
+    db.session.flush()
+    compact_positions(shift.calendar_id, old_date, old_position)
+    return True
+
+
+def skip_occurrence(recurrence, day):
+    """Remove one date from a recurrence by recording an exception."""
+    if day not in {e.exception_date for e in recurrence.exceptions}:
+        recurrence.exceptions.append(ShiftRecurrenceException(exception_date=day))
+
+
+def detach_occurrence(recurrence, day, shift_date=None, **fields):
+    """Replace one occurrence with a stored shift that can be edited on its own.
+    
+    Returns the new shift, or None if its day is full.
+    """
+    target = shift_date or day
+    lock_calendar(recurrence.calendar_id)
+    taken = count_day_shifts(recurrence.calendar_id, target) + count_occurrences(recurrence.calendar_id, target)
+    if target == day:
+        taken -= 1
+    if taken >= MAX_SHIFTS_PER_DAY:
+        return None
+    template = recurrence.template
+    skip_occurrence(recurrence, day)
+    db.session.flush()
+    values = {
+        'template_id': template.id,
+        'title': template.name,
+        'start_time': template.start_time,
+        'end_time': template.end_time,
+        'color': template.color
+    }
+    if fields:
+        # Edited values would otherwise be hidden behind the template's
+        values['template_id'] = None
+        values.update(fields)
+    return add_shift(recurrence.calendar_id, shift_date or day, **values)
+
+
+def skip_full_days(calendar_id, recurrences):
+    """Add exceptions where new or changed recurrences would exceed the daily limit.
+    
+    Days are checked up to the recurrence horizon, and past it on every day
+    that already has a stored shift, so a rule running beyond the horizon
+    doesn't fill days planned further ahead. Returns the skipped dates.
+    """
+    lock_calendar(calendar_id)
+    db.session.flush()
+    horizon_end = date.today() + timedelta(days=RECURRENCE_HORIZON_DAYS)
+    later_days = {day for (day,) in db.session.query(Shift.shift_date).filter(
+        Shift.calendar_id == calendar_id,
+        Shift.shift_date > horizon_end
+    ).distinct()}
+    
+    def checked_dates(recurrence):
+        days = occurrence_dates(recurrence, None, horizon_end)
+        if later_days:
+            days += [day for day in occurrence_dates(recurrence, horizon_end + timedelta(days=1), max(later_days))
+                     if day in later_days]
+        return days
+    
+    expanded = [(recurrence, checked_dates(recurrence)) for recurrence in recurrences]
+    all_dates = [day for _, days in expanded for day in days]
+    if not all_dates:
+        return []
+    first, last = min(all_dates), max(all_dates)
+    
+    taken = Counter(dict(db.session.query(Shift.shift_date, func.count(Shift.id)).filter(
+        Shift.calendar_id == calendar_id,
+        Shift.shift_date >= first,
+        Shift.shift_date <= last
+    ).group_by(Shift.shift_date).all()))
+    others = ShiftRecurrence.query.filter(
+        ShiftRecurrence.calendar_id == calendar_id,
+        ShiftRecurrence.dtstart <= last,
+        ShiftRecurrence.id.notin_([r.id for r in recurrences])
+    )
+    wanted = set(all_dates)
+    for other in others:
+        taken.update(day for day in checked_dates(other) if day in wanted)
+    
+    skipped = set()
+    for recurrence, days in expanded:
+        for day in days:
+            if taken[day] >= MAX_SHIFTS_PER_DAY:
+                skip_occurrence(recurrence, day)
+                skipped.add(day)
+            else:
+                taken[day] += 1
+    return sorted(skipped)
+
+
+def set_day_note(calendar_id, note_date, content):
+    """Create or replace the note for a day."""
+    note = DayNote.query.filter_by(calendar_id=calendar_id, note_date=note_date).first()
+    if note:
+        note.content = content
+    else:
+        note = DayNote(calendar_id=calendar_id, note_date=note_date, content=content)
+        db.session.add(note)
+    return note
@@ -9,6 +9,15 @@ document.addEventListener('DOMContentLoaded', function() {
     let dayNotes = {};
     let pendingOperations = new Set();
     let viewMode = 'month';
+    let viewCache = {};
+    let changeStream = null;
+    let changeReloadTimer = null;
+    let changePollTimer = null;
+    
+    const PREFETCH_ADJACENT_MONTHS = true;
+    const VIEW_CACHE_TTL = 60000;
+    const CHANGE_RELOAD_DELAY = 300;
+    const CHANGE_POLL_INTERVAL = 30000;
     
     function formatLocalDate(date) {
         var y = date.getFullYear();
@@ -377,6 +386,7 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     function saveNote(calendarId, dateStr, content, noteId, position) {
+        invalidateViewCache();
         var url = noteId ? window.API_BASE + 'api/day-notes/' + noteId : window.API_BASE + 'api/day-notes';
         var method = noteId ? 'PUT' : 'POST';
         
@@ -403,6 +413,7 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     function deleteNote(noteId, dateStr) {
+        invalidateViewCache();
         fetch(window.API_BASE + 'api/day-notes/' + noteId, { method: 'DELETE' })
             .then(function(res) { return res.json(); })
             .then(function() {
@@ -461,6 +472,117 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    function getMonthWindow(year, month) {
+        return {
+            start: formatLocalDate(new Date(year, month - 1, 1)),
+            end: formatLocalDate(new Date(year, month + 2, 0))
+        };
+    }
+    
+    function expandCalendarView(data) {
+        var viewShifts = data.shifts.map(function(s) {
+            var template = s.template_id ? data.templates[s.template_id] : null;
+            return {
+                id: s.id,
+                date: s.date,
+                position: s.position,
+                calendar_id: s.calendar_id || data.calendar_id,
+                template_id: s.template_id || null,
+                title: template ? template.name : s.title,
+                start_time: template ? template.start_time : s.start_time,
+                end_time: template ? template.end_time : s.end_time,
+                color: template ? template.color : s.color
+            };
+        });
+        var viewNotes = {};
+        data.notes.forEach(function(n) {
+            viewNotes[n.date] = n;
+        });
+        return { shifts: viewShifts, dayNotes: viewNotes };
+    }
+    
+    function fetchCalendarView(calendarId, start, end) {
+        var key = calendarId + '|' + start + '|' + end;
+        var cached = viewCache[key];
+        if (cached && Date.now() - cached.time < VIEW_CACHE_TTL) {
+            return cached.promise;
+        }
+        
+        var promise = fetch(window.API_BASE + 'api/calendar-view?calendar_id=' + calendarId + '&start=' + start + '&end=' + end)
+            .then(function(res) {
+                if (!res.ok) throw new Error('Failed to load calendar view');
+                return res.json();
+            })
+            .then(expandCalendarView);
+        viewCache[key] = { time: Date.now(), promise: promise };
+        promise.catch(function() { delete viewCache[key]; });
+        return promise;
+    }
+    
+    function invalidateViewCache() {
+        viewCache = {};
+    }
+    
+    function reloadVisibleView() {
+        if (pendingOperations.size > 0) {
+            // Let the user's own edit land before replacing the optimistic view
+            changeReloadTimer = setTimeout(reloadVisibleView, CHANGE_RELOAD_DELAY);
+            return;
+        }
+        invalidateViewCache();
+        if (viewMode === 'year') {
+            loadYearShifts();
+        } else {
+            loadShifts();
+        }
+    }
+    
+    function subscribeToChanges() {
+        if (changeStream) {
+            changeStream.close();
+            changeStream = null;
+        }
+        clearInterval(changePollTimer);
+        changePollTimer = null;
+        var calendarId = getActiveCalendarId();
+        if (!calendarId) return;
+        if (!window.EventSource) {
+            pollForChanges();
+            return;
+        }
+        
+        var stream = new EventSource(window.API_BASE + 'api/calendars/' + calendarId + '/stream');
+        function scheduleReload() {
+            clearTimeout(changeReloadTimer);
+            changeReloadTimer = setTimeout(reloadVisibleView, CHANGE_RELOAD_DELAY);
+        }
+        stream.addEventListener('change', scheduleReload);
+        stream.addEventListener('reset', scheduleReload);
+        stream.addEventListener('deleted', function() { stream.close(); });
+        stream.addEventListener('error', function() {
+            // The browser retries dropped connections itself but gives up on an error
+            // status, e.g. 503 when the worker has no stream slot left
+            if (stream.readyState === EventSource.CLOSED && changeStream === stream) {
+                changeStream = null;
+                pollForChanges();
+            }
+        });
+        changeStream = stream;
+    }
+    
+    function pollForChanges() {
+        changePollTimer = setInterval(function() {
+            if (!document.hidden) reloadVisibleView();
+        }, CHANGE_POLL_INTERVAL);
+    }
+    
+    function prefetchAdjacentMonths(calendarId, year, month) {
+        [month - 1, month + 1].forEach(function(m) {
+            var range = getMonthWindow(year, m);
+            fetchCalendarView(calendarId, range.start, range.end).catch(function() {});
+        });
+    }
+    
     function loadYearShifts() {
         var calendarId = getActiveCalendarId();
         if (!calendarId) {
@@ -474,10 +596,9 @@ document.addEventListener('DOMContentLoaded', function() {
         var start = year + '-01-01';
         var end = year + '-12-31';
         
-        fetch(window.API_BASE + 'api/shifts?calendar_id=' + calendarId + '&start=' + start + '&end=' + end)
-            .then(function(res) { return res.json(); })
-            .then(function(shiftsData) {
-                shifts = shiftsData;
+        fetchCalendarView(calendarId, start, end)
+            .then(function(view) {
+                shifts = view.shifts.slice();
                 pendingOperations.clear();
                 renderCalendar();
             })
@@ -495,26 +616,23 @@ document.addEventListener('DOMContentLoaded', function() {
         
         var year = currentDate.getFullYear();
         var month = currentDate.getMonth();
-        var start = formatLocalDate(new Date(year, month - 1, 1));
-        var end = formatLocalDate(new Date(year, month + 2, 0));
-        
-        Promise.all([
-            fetch(window.API_BASE + 'api/shifts?calendar_id=' + calendarId + '&start=' + start + '&end=' + end).then(function(res) { return res.json(); }),
-            fetch(window.API_BASE + 'api/day-notes?calendar_id=' + calendarId + '&start=' + start + '&end=' + end).then(function(res) { return res.json(); })
-        ])
-        .then(function(results) {
-            shifts = results[0];
-            dayNotes = {};
-            results[1].forEach(function(n) {
-                dayNotes[n.date] = n;
-            });
-            pendingOperations.clear();
-            renderCalendar();
-        })
-        .catch(function(err) { console.error('Failed to load data:', err); });
+        var range = getMonthWindow(year, month);
+        
+        fetchCalendarView(calendarId, range.start, range.end)
+            .then(function(view) {
+                shifts = view.shifts.slice();
+                dayNotes = Object.assign({}, view.dayNotes);
+                pendingOperations.clear();
+                renderCalendar();
+                if (PREFETCH_ADJACENT_MONTHS) {
+                    prefetchAdjacentMonths(calendarId, year, month);
+                }
+            })
+            .catch(function(err) { console.error('Failed to load data:', err); });
     }
     
     function createShiftFromTemplate(templateId, calendarId, dateStr, tempId) {
+        invalidateViewCache();
         fetch(window.API_BASE + 'api/shifts/from-template', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
@@ -571,6 +689,7 @@ document.addEventListener('DOMContentLoaded', function() {
         
         var dateStr = shift.date;
         pendingOperations.add(dateStr);
+        invalidateViewCache();
         
         var originalShifts = shifts.slice();
         shifts = shifts.filter(function(s) { return s.id != shiftId; });
@@ -712,8 +831,12 @@ document.addEventListener('DOMContentLoaded', function() {
     
     var calendarSelects = document.querySelectorAll('.calendar-select');
     for (var cs = 0; cs < calendarSelects.length; cs++) {
-        calendarSelects[cs].onchange = loadShifts;
+        calendarSelects[cs].onchange = function() {
+            loadShifts();
+            subscribeToChanges();
+        };
     }
     
     loadShifts();
+    subscribeToChanges();
 });
@@ -54,6 +54,47 @@ document.addEventListener('DOMContentLoaded', function() {
         .catch(err => console.error('Failed to save calendar:', err));
     });
     
+    const regenerateFeedToken = document.getElementById('regenerateFeedToken');
+    if (regenerateFeedToken) {
+        regenerateFeedToken.addEventListener('click', function() {
+            if (confirm('Create new merged feed URLs? Subscriptions using the current URLs will stop working.')) {
+                fetch(`${window.API_BASE}api/feed-token`, {
+                    method: 'POST'
+                })
+                .then(response => response.json())
+                .then(() => location.reload())
+                .catch(err => console.error('Failed to regenerate feed token:', err));
+            }
+        });
+    }
+    
+    document.getElementById('importBackup').addEventListener('click', function() {
+        const file = document.getElementById('backupFile').files[0];
+        if (!file) {
+            return;
+        }
+        const form = new FormData();
+        form.append('file', file);
+        this.disabled = true;
+        fetch(`${window.API_BASE}api/import`, {
+            method: 'POST',
+            body: form
+        })
+        .then(response => response.json())
+        .then(result => {
+            if (result.error) {
+                alert(`Restore failed: ${result.error}`);
+                this.disabled = false;
+                return;
+            }
+            location.reload();
+        })
+        .catch(err => {
+            console.error('Failed to restore backup:', err);
+            this.disabled = false;
+        });
+    });
+    
     document.querySelectorAll('.copy-btn').forEach(btn => {
         btn.addEventListener('click', function() {
             const inputGroup = this.closest('.input-group');
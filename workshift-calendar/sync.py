@@ -0,0 +1,126 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+import os
+
+from sqlalchemy.orm import joinedload
+
+from app import db
+from models import Calendar, DayNote, Shift, ShiftRecurrence, SyncTombstone
+from queries import note_rows, shift_rows, window_criteria
+from recurrence import expand_recurrences
+
+SYNC_TOMBSTONE_RETENTION_DAYS = int(os.environ.get("SYNC_TOMBSTONE_RETENTION_DAYS", "90"))
+
+Changes = namedtuple('Changes', ['shifts', 'notes', 'occurrences', 'deleted', 'day_notes'])
+
+
+class SyncTokenExpired(Exception):
+    """The client's sync token predates pruned tombstones or the calendar's history."""
+
+
+def current_sync_state(calendar_id):
+    """Return (feed_version, sync_floor) for a calendar straight from the database."""
+    row = db.session.query(Calendar.feed_version, Calendar.sync_floor).filter(Calendar.id == calendar_id).one()
+    return row.feed_version or 0, row.sync_floor or 0
+
+
+def parse_sync_token(token, calendar_id):
+    """Validate a sync token against the calendar and return the version it stands for.
+
+    Raises ValueError for malformed tokens and SyncTokenExpired when the
+    changes since the token can no longer be reconstructed.
+    """
+    version = int(token)
+    if version < 0:
+        raise ValueError('sync_token must not be negative')
+    current, floor = current_sync_state(calendar_id)
+    if version < floor or version > current:
+        raise SyncTokenExpired()
+    return version
+
+
+def prune_tombstones(calendar_id):
+    """Drop tombstones older than the retention period and raise the calendar's sync floor past them."""
+    cutoff = datetime.now() - timedelta(days=SYNC_TOMBSTONE_RETENTION_DAYS)
+    tombstones = SyncTombstone.__table__
+    pruned = db.session.execute(
+        db.select(db.func.max(tombstones.c.sync_version))
+        .where(tombstones.c.calendar_id == calendar_id, tombstones.c.deleted_at < cutoff)
+    ).scalar()
+    if pruned is None:
+        return
+    db.session.execute(tombstones.delete().where(
+        tombstones.c.calendar_id == calendar_id,
+        tombstones.c.sync_version <= pruned
+    ))
+    calendars = Calendar.__table__
+    db.session.execute(
+        calendars.update()
+        .where(calendars.c.id == calendar_id, db.func.coalesce(calendars.c.sync_floor, 0) < pruned)
+        .values(sync_floor=pruned)
+    )
+    db.session.commit()
+
+
+def changes_since(calendar_id, version, start_date=None, end_date=None):
+    """Collect what changed on a calendar after a sync version, optionally limited to a date window.
+
+    Shifts on days whose note changed are re-sent because the note is their
+    description. A changed recurrence is reported as deleted and its
+    occurrences in the window are re-sent, so clients can replace them as
+    a group.
+    """
+    notes = note_rows(DayNote.calendar_id == calendar_id, DayNote.sync_version > version,
+                      *window_criteria(DayNote.note_date, start_date, end_date))
+    tombstones = SyncTombstone.query.filter(
+        SyncTombstone.calendar_id == calendar_id,
+        SyncTombstone.sync_version > version
+    ).order_by(SyncTombstone.sync_version).all()
+    tombstones = [t for t in tombstones if t.entity_date is None or (
+        (not start_date or t.entity_date >= start_date) and (not end_date or t.entity_date <= end_date))]
+
+    touched_dates = {n.note_date for n in notes} | {t.entity_date for t in tombstones if t.entity_type == 'note'}
+    shift_filter = Shift.sync_version > version
+    if touched_dates:
+        shift_filter = db.or_(shift_filter, Shift.shift_date.in_(touched_dates))
+    shifts = shift_rows(Shift.calendar_id == calendar_id, shift_filter, *window_criteria(Shift.shift_date, start_date, end_date))
+
+    # Occurrence positions follow the stored shifts of their day, so re-send them wherever those changed
+    touched_dates |= {s.shift_date for s in shifts}
+    touched_dates |= {t.entity_date for t in tombstones if t.entity_type == 'event' and t.entity_date}
+    recurrences = ShiftRecurrence.query.filter_by(calendar_id=calendar_id).options(joinedload(ShiftRecurrence.template)).all()
+    changed_recurrences = {r.id for r in recurrences if (r.sync_version or 0) > version}
+    occurrences = []
+    deleted = [{'type': t.entity_type, 'id': t.entity_id, 'date': t.entity_date.isoformat() if t.entity_date else None}
+               for t in tombstones]
+    if recurrences and (changed_recurrences or touched_dates):
+        day_counts = db.session.query(Shift.calendar_id, Shift.shift_date).filter(
+            Shift.calendar_id == calendar_id, *window_criteria(Shift.shift_date, start_date, end_date)).all()
+        occurrences = [o for o in expand_recurrences(recurrences, start_date, end_date, day_counts)
+                       if o.recurrence.id in changed_recurrences or o.date in touched_dates]
+        deleted.extend({'type': 'recurrence', 'id': recurrence_id, 'date': None} for recurrence_id in sorted(changed_recurrences))
+
+    event_dates = {s.shift_date for s in shifts} | {o.date for o in occurrences}
+    day_notes = {}
+    if event_dates:
+        day_notes = {n.note_date: n.content for n in note_rows(
+            DayNote.calendar_id == calendar_id, DayNote.note_date.in_(event_dates))}
+    return Changes(shifts, notes, occurrences, deleted, day_notes)
+
+
+def change_summary(calendar_id, version):
+    """Dates and recurrence ids changed on a calendar after a sync version, without loading the rows."""
+    dates = set()
+    for model, column in ((Shift, Shift.shift_date), (DayNote, DayNote.note_date)):
+        dates.update(day for (day,) in db.session.query(column).filter(
+            model.calendar_id == calendar_id, model.sync_version > version).distinct())
+    recurrence_ids = {recurrence_id for (recurrence_id,) in db.session.query(ShiftRecurrence.id).filter(
+        ShiftRecurrence.calendar_id == calendar_id, ShiftRecurrence.sync_version > version)}
+    tombstones = db.session.query(SyncTombstone.entity_type, SyncTombstone.entity_id, SyncTombstone.entity_date).filter(
+        SyncTombstone.calendar_id == calendar_id, SyncTombstone.sync_version > version)
+    for entity_type, entity_id, entity_date in tombstones:
+        if entity_type == 'recurrence':
+            recurrence_ids.add(entity_id)
+        elif entity_date:
+            dates.add(entity_date)
+    return sorted(dates), sorted(recurrence_ids)